@@ -1,17 +1,89 @@
+import io
 import os
+import csv
+import gzip
 import json
+import time
+import zlib
+import hashlib
+import atexit
+import functools
+import contextlib
+import base64
+import itertools
+import threading
+from collections import OrderedDict, deque, namedtuple
 import datetime as dt
-from flask import Flask, request, jsonify, make_response
+import click
+from flask import Flask, Response, request, jsonify, url_for
 
 # ───────────────────────── DB (SQLite locally, PostgreSQL on Render) ─────────────────────────
-from sqlalchemy import create_engine, Column, Integer, String, DateTime
+from sqlalchemy import bindparam, create_engine, event, func, inspect, select, text, tuple_, BigInteger, Column, Integer, String, DateTime, Index, UniqueConstraint
 from sqlalchemy.orm import sessionmaker, declarative_base
 
+try:  # optional: much faster JSON encoding for the read path
+    import orjson
+except ImportError:
+    orjson = None
+
+try:  # optional: brotli variants of the static assets
+    import brotli
+except ImportError:
+    brotli = None
+
 DATABASE_URL = os.getenv("DATABASE_URL")  # Render PostgreSQL
 if DATABASE_URL and DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
-engine = create_engine(DATABASE_URL or "sqlite:///scans.db", pool_pre_ping=True)
+DATABASE_URL = DATABASE_URL or "sqlite:///scans.db"
+
+# SQLite profile: WAL lets readers run alongside the single writer, and busy_timeout makes
+# writers from other gunicorn workers wait for the lock instead of failing immediately.
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+# PostgreSQL profile: no per-checkout ping. Connections are recycled before typical
+# server/proxy idle cutoffs, TCP keepalives catch dead peers, and SQLAlchemy invalidates
+# the pool when a statement hits a disconnect error.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "0") == "1"
+
+# PostgreSQL only: scans as a table range-partitioned by month on timestamp. Must match how
+# the table was created (init-db / `flask partitions --convert`); ignored on SQLite.
+SCANS_PARTITIONED = os.getenv("SCANS_PARTITIONED", "0") == "1"
+
+
+def engine_options(url):
+    """create_engine() keyword arguments for the database named by url."""
+    if url.startswith("sqlite"):
+        return {"connect_args": {"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "pool_use_lifo": True,  # idle extras age out via recycle instead of all staying warm
+        "connect_args": {"connect_timeout": 5, "keepalives": 1, "keepalives_idle": 30, "keepalives_interval": 10, "keepalives_count": 3},
+    }
+
+
+engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, record):
+        cur = dbapi_conn.cursor()
+        if engine.url.database not in (None, "", ":memory:"):
+            cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cur.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cur.close()
+
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 Base = declarative_base()
 
@@ -22,9 +94,161 @@ class Scan(Base):
     sku = Column(String(128), index=True, nullable=False)
     count = Column(Integer, default=1, nullable=False)
     timestamp = Column(DateTime, default=dt.datetime.utcnow, nullable=False)
+    # Origin of the row: (device, IndexedDB id) identifies a scan across client retries.
+    device_id = Column(String(64), nullable=True)
+    client_id = Column(String(64), nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint("device_id", "client_id", name="uq_scans_device_client"),
+        # Serves newest-first listing and keyset pagination without a sort.
+        Index("ix_scans_timestamp_id", "timestamp", "id"),
+        # Same for pages filtered by ?sku=.
+        Index("ix_scans_sku_timestamp_id", "sku", "timestamp", "id"),
+    )
+
+
+class SkuTotal(Base):
+    """Running per-SKU totals, maintained in the same transaction as scan inserts."""
+    __tablename__ = "sku_totals"
+    sku = Column(String(128), primary_key=True)
+    total_count = Column(BigInteger, nullable=False, default=0)  # sums of 32-bit counts outgrow INTEGER
+    first_seen = Column(DateTime, nullable=False)
+    last_seen = Column(DateTime, nullable=False)
+
+
+class _Rollup:
+    """Per-(bucket, sku) counters at one granularity; same counter columns as sku_totals."""
+    bucket = Column(DateTime, primary_key=True)
+    sku = Column(String(128), primary_key=True)
+    total_count = Column(BigInteger, nullable=False, default=0)
+    first_seen = Column(DateTime, nullable=False)
+    last_seen = Column(DateTime, nullable=False)
+
+
+class HourlyRollup(_Rollup, Base):
+    __tablename__ = "scan_rollups_hourly"
+    __table_args__ = (Index("ix_scan_rollups_hourly_sku_bucket", "sku", "bucket"),)
+
+
+class DailyRollup(_Rollup, Base):
+    __tablename__ = "scan_rollups_daily"
+    __table_args__ = (Index("ix_scan_rollups_daily_sku_bucket", "sku", "bucket"),)
+
+
+ROLLUPS = {"hour": HourlyRollup, "day": DailyRollup}
+
+
+class ScanArchive(Base):
+    """A file under ARCHIVE_DIR holding scans of one month that were moved out of scans."""
+    __tablename__ = "scan_archives"
+    id = Column(Integer, primary_key=True)
+    month = Column(DateTime, nullable=False, index=True)  # first instant of the month
+    path = Column(String(255), nullable=False, unique=True)  # relative to ARCHIVE_DIR
+    format = Column(String(16), nullable=False)
+    rows = Column(Integer, nullable=False)
+    last_seq = Column(Integer, nullable=False)
+    archived_at = Column(DateTime, nullable=False, default=dt.datetime.utcnow)
+
+
+class Product(Base):
+    """SKU catalog, loaded through /api/products/import."""
+    __tablename__ = "products"
+    sku = Column(String(128), primary_key=True)
+    name = Column(String(255), nullable=True)
+    expected_qty = Column(Integer, nullable=True)
+    # Set to the import's start time; max(updated_at) versions enriched responses.
+    updated_at = Column(DateTime, nullable=False, default=dt.datetime.utcnow, index=True)
+
+
+def migrate_scans(conn):
+    """
+    Brings a scans table from before idempotent ingestion up to date: adds the origin
+    columns, then the dedup constraint. Safe to run again. Returns what it changed.
+    """
+    insp = inspect(conn)
+    if not insp.has_table("scans"):
+        return []
+    changes = []
+    columns = {c["name"] for c in insp.get_columns("scans")}
+    for name in ("device_id", "client_id"):
+        if name not in columns:
+            conn.execute(text(f"ALTER TABLE scans ADD COLUMN {name} VARCHAR({Scan.__table__.c[name].type.length})"))
+            changes.append(f"scans.{name}")
+    uniques = {u["name"] for u in insp.get_unique_constraints("scans")}
+    uniques |= {i["name"] for i in insp.get_indexes("scans") if i["unique"]}
+    if "uq_scans_device_client" not in uniques:
+        if conn.dialect.name == "postgresql":
+            conn.execute(text("ALTER TABLE scans ADD CONSTRAINT uq_scans_device_client UNIQUE (device_id, client_id)"))
+        else:  # SQLite cannot add constraints to a table; a unique index serves ON CONFLICT the same way
+            conn.execute(text("CREATE UNIQUE INDEX uq_scans_device_client ON scans (device_id, client_id)"))
+        changes.append("uq_scans_device_client")
+    return changes
 
 
-Base.metadata.create_all(bind=engine)
+def migrate_counters(conn):
+    """
+    Widens total_count to BIGINT on counter tables created while it was INTEGER (a
+    PostgreSQL rewrite of each table; SQLite's INTEGER is already 64-bit). Returns what it changed.
+    """
+    if conn.dialect.name != "postgresql":
+        return []
+    insp = inspect(conn)
+    changes = []
+    for model in (SkuTotal, *ROLLUPS.values()):
+        if not insp.has_table(model.__tablename__):
+            continue
+        column = next(c for c in insp.get_columns(model.__tablename__) if c["name"] == "total_count")
+        if not isinstance(column["type"], BigInteger):
+            conn.execute(text(f"ALTER TABLE {model.__tablename__} ALTER COLUMN total_count TYPE BIGINT"))
+            changes.append(f"{model.__tablename__}.total_count")
+    return changes
+
+
+def create_missing_indexes(conn):
+    """
+    Indexes declared on the models but absent from tables that already existed, which
+    create_all() leaves alone. On PostgreSQL each build blocks writes to its table.
+    """
+    insp = inspect(conn)
+    changes = []
+    for table in Base.metadata.sorted_tables:
+        have = {i["name"] for i in insp.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if index.name not in have:
+                index.create(conn)
+                changes.append(index.name)
+    return changes
+
+
+def init_db():
+    """
+    Creates missing tables, migrates older ones (columns, constraints, indexes) and fills
+    derived tables it had to create from existing scans. Run once per deploy before the
+    workers start (`flask --app app init-db`); running it again changes nothing.
+    Returns what it changed; ValueError if SCANS_PARTITIONED=1 names a plain scans table.
+    """
+    with engine.begin() as conn:
+        insp = inspect(conn)
+        missing = {t.name for t in Base.metadata.sorted_tables if not insp.has_table(t.name)}
+        if SCANS_PARTITIONED and engine.dialect.name == "postgresql" and "scans" not in missing \
+                and not scans_is_partitioned(conn):
+            # Ingest would use the partitioned dedup key, which a plain table has no constraint for.
+            raise ValueError("SCANS_PARTITIONED=1 but scans is a plain table: run `flask --app app partitions --convert` first")
+        if SCANS_PARTITIONED and engine.dialect.name == "postgresql" and "scans" in missing:
+            create_partitioned_scans(conn)
+            ensure_partitions(conn, PARTITION_MONTHS_AHEAD)
+        changes = migrate_scans(conn) + migrate_counters(conn)
+        # One connection throughout: SQLite's index list can lag DDL done on another one.
+        Base.metadata.create_all(bind=conn)
+        changes += sorted(missing) + create_missing_indexes(conn)
+    with engine.begin() as conn:
+        if "scans" not in missing:  # history from before these tables existed
+            if SkuTotal.__tablename__ in missing:
+                rebuild_totals(conn)
+            for granularity, model in ROLLUPS.items():
+                if model.__tablename__ in missing:
+                    rebuild_rollup(conn, granularity)
+    return changes
 
 # ───────────────────────── Flask app ─────────────────────────
 app = Flask(__name__)
@@ -35,6 +259,298 @@ def health():
     return {"status": "ok"}
 
 
+# ───────────────────────── Metrics ─────────────────────────
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+# Shared directory (e.g. a tmpfs cleared at gunicorn start) where each worker publishes
+# its counters, so any worker's /metrics can report the sum across all of them.
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_FLUSH_S = 1.0
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "250"))
+
+_SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+HISTOGRAM_BUCKETS = {
+    "scan_request_seconds": _SECONDS_BUCKETS,
+    "scan_phase_seconds": _SECONDS_BUCKETS,
+    "db_query_seconds": _SECONDS_BUCKETS,
+    "db_pool_wait_seconds": _SECONDS_BUCKETS,
+    "scan_batch_rows": (1, 10, 50, 100, 500, 1000, 5000, 10000, 50000),
+}
+METRIC_HELP = {
+    "scan_request_seconds": "Handler wall time",
+    "scan_requests_total": "Handled requests by status",
+    "scan_phase_seconds": "Wall time per handler phase",
+    "scan_batch_rows": "Rows per accepted upload",
+    "scan_rows_ingested_total": "Scan rows inserted",
+    "scan_rows_duplicate_total": "Scan rows skipped as already stored",
+    "scan_rows_rejected_total": "Scan rows rejected by validation",
+    "scans_cache_requests_total": "/api/scans body cache lookups",
+    "scan_rows_unknown_sku_total": "Accepted scan rows whose SKU is not in the catalog",
+    "catalog_cache_requests_total": "Catalog lookups by SKU",
+    "catalog_rows_imported_total": "Catalog rows upserted by imports",
+    "stream_subscribers": "Open /api/stream connections",
+    "stream_events_total": "Scan events published to /api/stream subscribers",
+    "stream_overflows_total": "Subscriber buffers that overflowed and fell back to a database catch-up",
+    "db_query_seconds": "Statement execution time",
+    "db_slow_queries_total": f"Statements slower than {SLOW_QUERY_MS:g}ms",
+    "db_pool_wait_seconds": "Time to check a connection out of the pool",
+    "db_pool_checkouts_total": "Pool checkouts",
+    "db_pool_connections_opened_total": "New DBAPI connections",
+    "db_pool_checked_out": "Connections currently checked out",
+}
+
+
+class _NullMetrics:
+    """Stand-in when METRICS_ENABLED is off: every call is a no-op."""
+    enabled = False
+    _phase = contextlib.nullcontext()
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    def add(self, name, delta, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def phase(self, endpoint, phase):
+        return self._phase
+
+    def start_publisher(self):
+        pass
+
+
+class Metrics(_NullMetrics):
+    """
+    Per-process counters, gauges and fixed-bucket histograms rendered in the Prometheus
+    text format. With METRICS_DIR a background thread in each worker writes a snapshot to
+    <dir>/<pid>.json once a second (and the scraping worker right before a scrape);
+    /metrics sums every snapshot. Counters of exited workers are kept, gauges only
+    count live ones.
+    """
+    enabled = True
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._publisher_pid = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def add(self, name, delta, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + delta
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        bounds = HISTOGRAM_BUCKETS[name]
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = [[0] * len(bounds), 0.0, 0]
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    h[0][i] += 1
+                    break
+            h[1] += value
+            h[2] += 1
+
+    @contextlib.contextmanager
+    def phase(self, endpoint, phase):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("scan_phase_seconds", time.perf_counter() - t0, endpoint=endpoint, phase=phase)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": [[n, list(l), v] for (n, l), v in self._counters.items()],
+                "gauges": [[n, list(l), v] for (n, l), v in self._gauges.items()],
+                "histograms": [[n, list(l), list(h[0]), h[1], h[2]] for (n, l), h in self._histograms.items()],
+            }
+
+    def start_publisher(self):
+        """Starts this worker's snapshot publisher (after fork, so one per gunicorn worker)."""
+        if not self.directory or self._publisher_pid == os.getpid():
+            return
+        self._publisher_pid = os.getpid()
+        threading.Thread(target=self._publish_forever, name="metrics-publisher", daemon=True).start()
+
+    def _publish_forever(self):
+        while True:
+            time.sleep(METRICS_FLUSH_S)
+            try:
+                self.flush()
+            except OSError:
+                app.logger.exception("could not publish metrics snapshot")
+
+    def flush(self):
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + ".tmp", path)
+
+    def _snapshots(self):
+        if not self.directory:
+            yield self.snapshot(), True
+            return
+        self.flush()
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snap = json.load(f)
+            except (OSError, ValueError):
+                continue
+            yield snap, _pid_alive(int(name[:-5]))
+
+    def render(self):
+        counters, gauges, histograms = {}, {}, {}
+        for snap, alive in self._snapshots():
+            for n, l, v in snap["counters"]:
+                key = (n, tuple(map(tuple, l)))
+                counters[key] = counters.get(key, 0) + v
+            if alive:
+                for n, l, v in snap["gauges"]:
+                    key = (n, tuple(map(tuple, l)))
+                    gauges[key] = gauges.get(key, 0) + v
+            for n, l, buckets, total, count in snap["histograms"]:
+                key = (n, tuple(map(tuple, l)))
+                h = histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+                h[0] = [a + b for a, b in zip(h[0], buckets)]
+                h[1] += total
+                h[2] += count
+
+        out = []
+        for kind, series in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({n for n, _ in series}):
+                out.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                out.append(f"# TYPE {name} {kind}")
+                out.extend(f"{name}{_labels(l)} {v:g}" for (n, l), v in sorted(series.items()) if n == name)
+        for name in sorted({n for n, _ in histograms}):
+            out.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+            out.append(f"# TYPE {name} histogram")
+            for (n, l), (buckets, total, count) in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, c in zip(HISTOGRAM_BUCKETS[name], buckets):
+                    cumulative += c
+                    out.append(f"{name}_bucket{_labels(l + (('le', f'{bound:g}'),))} {cumulative}")
+                out.append(f"{name}_bucket{_labels(l + (('le', '+Inf'),))} {count}")
+                out.append(f"{name}_sum{_labels(l)} {total:g}")
+                out.append(f"{name}_count{_labels(l)} {count}")
+        return "\n".join(out) + "\n"
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+metrics = Metrics(METRICS_DIR) if METRICS_ENABLED else _NullMetrics()
+
+
+def instrumented(endpoint):
+    """Times a view and counts its responses by status; a plain passthrough when disabled."""
+    def wrap(view):
+        if not metrics.enabled:
+            return view
+
+        @functools.wraps(view)
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            resp = app.make_response(view(*args, **kwargs))
+            metrics.observe("scan_request_seconds", time.perf_counter() - t0, endpoint=endpoint)
+            metrics.inc("scan_requests_total", endpoint=endpoint, status=str(resp.status_code))
+            metrics.start_publisher()
+            return resp
+        return timed
+    return wrap
+
+
+def connect():
+    """engine.connect() with the pool checkout wait recorded."""
+    if not metrics.enabled:
+        return engine.connect()
+    t0 = time.perf_counter()
+    conn = engine.connect()
+    metrics.observe("db_pool_wait_seconds", time.perf_counter() - t0)
+    return conn
+
+
+if metrics.enabled:
+    @event.listens_for(engine, "before_cursor_execute")
+    def _query_started(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_t0", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _query_finished(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_t0"].pop()
+        metrics.observe("db_query_seconds", elapsed)
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            metrics.inc("db_slow_queries_total")
+            app.logger.warning("slow query (%.1f ms%s): %s", elapsed * 1000, ", executemany" if executemany else "", statement[:500])
+
+    @event.listens_for(engine, "handle_error")
+    def _query_failed(ctx):
+        stack = ctx.connection.info.get("query_t0") if ctx.connection is not None else None
+        if stack:
+            stack.pop()
+
+    @event.listens_for(engine.pool, "connect")
+    def _pool_connect(dbapi_conn, record):
+        metrics.inc("db_pool_connections_opened_total")
+
+    @event.listens_for(engine.pool, "checkout")
+    def _pool_checkout(dbapi_conn, record, proxy):
+        metrics.inc("db_pool_checkouts_total")
+        metrics.add("db_pool_checked_out", 1)
+
+    @event.listens_for(engine.pool, "checkin")
+    def _pool_checkin(dbapi_conn, record):
+        metrics.add("db_pool_checked_out", -1)
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    if not metrics.enabled:
+        return jsonify({"error": "metrics disabled"}), 404
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 # ───────────────────────── HTML (PWA) ─────────────────────────
 INDEX_HTML = """<!doctype html>
 <html lang="en">
@@ -43,7 +559,7 @@ INDEX_HTML = """<!doctype html>
   <meta name="viewport" content="width=device-width, initial-scale=1, viewport-fit=cover"/>
   <title>Inventory Scanner</title>
   <meta name="theme-color" content="#111111"/>
-  <link rel="manifest" href="/manifest.json">
+  <link rel="manifest" href="__MANIFEST_URL__">
   <style>
     html,body{margin:0;padding:0;font-family:system-ui,-apple-system,Segoe UI,Roboto,Inter,Arial,sans-serif;background:#0f1115;color:#e6e8eb}
     header{padding:12px 16px;border-bottom:1px solid #222}
@@ -121,6 +637,7 @@ INDEX_HTML = """<!doctype html>
     <h3>Server History (synced)</h3>
     <div class="row">
       <button id="refreshServer" class="secondary">Refresh</button>
+      <button id="olderServer" class="secondary" disabled>Load older</button>
     </div>
     <table id="serverTable">
       <thead><tr><th>SKU</th><th>Count</th><th>Timestamp (UTC)</th></tr></thead>
@@ -129,7 +646,6 @@ INDEX_HTML = """<!doctype html>
   </section>
 </main>
 
-<script src="https://unpkg.com/@ericblade/quagga2/dist/quagga.js"></script>
 <script>
 /* ───────── PWA registration ───────── */
 if ('serviceWorker' in navigator) {
@@ -151,6 +667,7 @@ const lastScan = document.getElementById('lastScan');
 const aggTableBody = document.querySelector('#aggTable tbody');
 const serverTableBody = document.querySelector('#serverTable tbody');
 const preview = document.getElementById('preview');
+const guide = document.getElementById('guide');
 const cameraSelect = document.getElementById('cameraSelect');
 const resSelect = document.getElementById('resSelect');
 const startBtn = document.getElementById('startBtn');
@@ -164,29 +681,80 @@ function setLast(msg){ lastScan.textContent = msg; }
 /* ───────── IndexedDB ───────── */
 const DB_NAME = 'inv_scanner_db';
 const STORE = 'scans';
-function idbOpen(){ return new Promise((res,rej)=>{ const r = indexedDB.open(DB_NAME,1);
-  r.onupgradeneeded=e=>{ const db=e.target.result; if(!db.objectStoreNames.contains(STORE)){ const os=db.createObjectStore(STORE,{keyPath:'id',autoIncrement:true}); os.createIndex('sku','sku'); os.createIndex('synced','synced'); } };
-  r.onsuccess=()=>res(r.result); r.onerror=()=>rej(r.error); });}
-async function idbAddScan(sku,count,ts,synced=false){ const db=await idbOpen(); return new Promise((res,rej)=>{ const tx=db.transaction(STORE,'readwrite'); tx.objectStore(STORE).add({sku,count,ts,synced}); tx.oncomplete=()=>res(true); tx.onerror=()=>rej(tx.error); });}
-async function idbGetAll(onlyUnsynced=false){ const db=await idbOpen(); return new Promise((res,rej)=>{ const tx=db.transaction(STORE,'readonly'); const st=tx.objectStore(STORE); const req=onlyUnsynced?st.index('synced').getAll(false):st.getAll(); req.onsuccess=()=>res(req.result||[]); req.onerror=()=>rej(req.error); });}
-async function idbMarkSynced(ids){ const db=await idbOpen(); return new Promise((res,rej)=>{ const tx=db.transaction(STORE,'readwrite'); const st=tx.objectStore(STORE);
-  ids.forEach(id=>{ const g=st.get(id); g.onsuccess=()=>{ const rec=g.result; if(rec){ rec.synced=true; st.put(rec);} };});
+const AGG = 'agg';  // sku -> {sku, count, last_ts, compacted}, kept in step with STORE
+// synced is stored as 0/1: booleans are not valid IndexedDB keys, so the index skipped them.
+// REJECTED: the server refused the record as sent; it keeps the reason and is not uploaded again.
+const UNSYNCED = 0, SYNCED = 1, REJECTED = 2;
+let dbPromise = null;
+function idbOpen(){ return dbPromise || (dbPromise = new Promise((res,rej)=>{ const r = indexedDB.open(DB_NAME,3);
+  r.onupgradeneeded=e=>{ const db=e.target.result, tx=e.target.transaction;
+    if(!db.objectStoreNames.contains(STORE)){ const os=db.createObjectStore(STORE,{keyPath:'id',autoIncrement:true}); os.createIndex('sku','sku'); os.createIndex('synced','synced'); }
+    if(e.oldVersion < 2){ db.createObjectStore(AGG,{keyPath:'sku'}); idbBuildAgg(tx); }
+    if(e.oldVersion > 0 && e.oldVersion < 3){ const cur=tx.objectStore(STORE).openCursor();
+      cur.onsuccess=()=>{ const c=cur.result; if(!c) return; const v=c.value; v.synced=v.synced?SYNCED:UNSYNCED; c.update(v); c.continue(); }; } };
+  r.onsuccess=()=>res(r.result); r.onerror=()=>{ dbPromise=null; rej(r.error); }; })); }
+// One-time migration: fold every existing scan record into the aggregate store
+function idbBuildAgg(tx){ const map=new Map(); const cur=tx.objectStore(STORE).openCursor();
+  cur.onsuccess=()=>{ const c=cur.result; if(c){ aggFold(map, c.value.sku, c.value); c.continue(); } else { const agg=tx.objectStore(AGG); map.forEach(v=>agg.put(v)); } }; }
+function aggFold(map, sku, r){ const prev=map.get(sku)||{sku,count:0,last_ts:null}; prev.count+=Number(r.count||1); if(!prev.last_ts || r.ts>prev.last_ts) prev.last_ts=r.ts; map.set(sku,prev); return prev; }
+// Adds the scan and bumps its SKU aggregate in one transaction; resolves with the new aggregate
+async function idbAddScan(sku,count,ts,synced=false){ const db=await idbOpen(); return new Promise((res,rej)=>{ const tx=db.transaction([STORE,AGG],'readwrite'); let out=null;
+  tx.objectStore(STORE).add({sku,count,ts,synced:synced?SYNCED:UNSYNCED});
+  const agg=tx.objectStore(AGG); const g=agg.get(sku); g.onsuccess=()=>{ const m=new Map(g.result?[[sku,g.result]]:[]); out=aggFold(m,sku,{count,ts}); agg.put(out); };
+  tx.oncomplete=()=>res(out); tx.onerror=()=>rej(tx.error); });}
+async function idbGetAll(onlyUnsynced=false){ const db=await idbOpen(); return new Promise((res,rej)=>{ const tx=db.transaction(STORE,'readonly'); const st=tx.objectStore(STORE); const req=onlyUnsynced?st.index('synced').getAll(UNSYNCED):st.getAll(); req.onsuccess=()=>res(req.result||[]); req.onerror=()=>rej(req.error); });}
+async function idbGetAgg(){ const db=await idbOpen(); return new Promise((res,rej)=>{ const req=db.transaction(AGG,'readonly').objectStore(AGG).getAll(); req.onsuccess=()=>res(req.result||[]); req.onerror=()=>rej(req.error); });}
+// One cursor pass over the unsynced entries of the synced index, flipping the ones the server acked
+// and parking the ones it rejected (id -> error) with their reason
+async function idbMarkSynced(ids, rejected=new Map()){ const db=await idbOpen(); const want=new Set(ids), bad=new Map(rejected); return new Promise((res,rej)=>{ const tx=db.transaction(STORE,'readwrite');
+  const cur=tx.objectStore(STORE).index('synced').openCursor(IDBKeyRange.only(UNSYNCED));
+  cur.onsuccess=()=>{ const c=cur.result; if(!c || !(want.size || bad.size)) return; const v=c.value;
+    if(want.delete(c.primaryKey)){ v.synced=SYNCED; c.update(v); }
+    else if(bad.has(c.primaryKey)){ v.synced=REJECTED; v.error=bad.get(c.primaryKey); bad.delete(c.primaryKey); c.update(v); }
+    c.continue(); };
+  tx.oncomplete=()=>res(true); tx.onerror=()=>rej(tx.error); });}
+async function idbGetRejected(){ const db=await idbOpen(); return new Promise((res,rej)=>{ const req=db.transaction(STORE,'readonly').objectStore(STORE).index('synced').getAll(REJECTED); req.onsuccess=()=>res(req.result||[]); req.onerror=()=>rej(req.error); });}
+// Folds old synced records into their SKU aggregate and deletes them: records older than
+// maxAgeHours, and the oldest beyond the newest maxSynced. Aggregate counts are unchanged.
+async function idbCompact(maxAgeHours, maxSynced){ const db=await idbOpen(); return new Promise((res,rej)=>{ const tx=db.transaction([STORE,AGG],'readwrite');
+  const idx=tx.objectStore(STORE).index('synced'), agg=tx.objectStore(AGG); const folded=new Map(); let removed=0;
+  const cutoff=new Date(Date.now()-maxAgeHours*3600e3).toISOString();
+  const total=idx.count(IDBKeyRange.only(SYNCED));
+  total.onsuccess=()=>{ let excess=total.result-maxSynced; const cur=idx.openCursor(IDBKeyRange.only(SYNCED));
+    cur.onsuccess=()=>{ const c=cur.result;
+      // primary-key order is scan order, so the first record that is neither excess nor old ends the pass
+      if(c && (excess>0 || c.value.ts<cutoff)){ const v=c.value; folded.set(v.sku,(folded.get(v.sku)||0)+1); c.delete(); removed++; excess--; c.continue(); return; }
+      folded.forEach((n,sku)=>{ const g=agg.get(sku); g.onsuccess=()=>{ if(g.result){ g.result.compacted=(g.result.compacted||0)+n; agg.put(g.result); } }; }); }; };
+  tx.oncomplete=()=>res(removed); tx.onerror=()=>rej(tx.error); });}
+// Deletes unsynced and rejected scans and takes them back out of the aggregates, atomically
+async function idbClearUnsynced(){ const db=await idbOpen(); return new Promise((res,rej)=>{ const tx=db.transaction([STORE,AGG],'readwrite'); const st=tx.objectStore(STORE), agg=tx.objectStore(AGG); const removed=new Map();
+  const cur=st.index('synced').openCursor();
+  cur.onsuccess=()=>{ const c=cur.result;
+    if(c && c.key===SYNCED){ c.continue(REJECTED); return; }
+    if(c){ removed.set(c.value.sku,(removed.get(c.value.sku)||0)+Number(c.value.count||1)); c.delete(); c.continue(); return; }
+    removed.forEach((n,sku)=>{ const g=agg.get(sku); g.onsuccess=()=>{ const a=g.result; if(!a) return; a.count-=n;
+      if(a.count<=0){ agg.delete(sku); return; }
+      const left=st.index('sku').getAll(sku); left.onsuccess=()=>{ if(left.result.length) a.last_ts=left.result.reduce((m,r)=>r.ts>m?r.ts:m,''); agg.put(a); }; }; }); };
   tx.oncomplete=()=>res(true); tx.onerror=()=>rej(tx.error); });}
-async function idbClearUnsynced(){ const db=await idbOpen(); const all=await idbGetAll(false); const del=all.filter(x=>!x.synced).map(x=>x.id);
-  return new Promise((res,rej)=>{ const tx=db.transaction(STORE,'readwrite'); const st=tx.objectStore(STORE); del.forEach(id=>st.delete(id)); tx.oncomplete=()=>res(true); tx.onerror=()=>rej(tx.error); });}
 
 /* ───────── Local aggregation ───────── */
+const aggRows = new Map();  // sku -> <tr>, so a scan only touches its own row
+function renderAggRow(a){
+  let tr=aggRows.get(a.sku);
+  if(!tr){ tr=document.createElement('tr'); tr.append(document.createElement('td'),document.createElement('td'),document.createElement('td')); tr.cells[0].textContent=a.sku;
+    // binary search for the sorted position among existing rows
+    const rows=aggTableBody.rows; let lo=0, hi=rows.length;
+    while(lo<hi){ const mid=(lo+hi)>>1; if(rows[mid].cells[0].textContent.localeCompare(a.sku)<0) lo=mid+1; else hi=mid; }
+    aggTableBody.insertBefore(tr, rows[lo]||null); aggRows.set(a.sku,tr); }
+  tr.cells[1].textContent=a.count; tr.cells[2].textContent=a.last_ts ? new Date(a.last_ts).toISOString() : '';
+}
 async function refreshLocalAgg(){
-  const all = await idbGetAll(false);
-  const map = new Map();
-  for (const r of all){ const k=r.sku; const prev=map.get(k)||{count:0,ts:null}; prev.count+=Number(r.count||1); prev.ts = prev.ts?Math.max(prev.ts, r.ts):r.ts; map.set(k,prev); }
-  aggTableBody.innerHTML='';
-  [...map.entries()].sort((a,b)=>a[0].localeCompare(b[0])).forEach(([sku,info])=>{
-    const tr=document.createElement('tr'); tr.innerHTML=`<td>${sku}</td><td>${info.count}</td><td>${new Date(info.ts).toISOString()}</td>`; aggTableBody.appendChild(tr);});
+  const all = await idbGetAgg();
+  aggTableBody.innerHTML=''; aggRows.clear();
+  all.sort((a,b)=>a.sku.localeCompare(b.sku)).forEach(renderAggRow);
 }
 
 /* ───────── Camera management ───────── */
-let quaggaRunning = false;
 let currentStreamTrack = null;
 let plainStream = null;
 
@@ -252,7 +820,7 @@ async function startScanner() {
     ? { video: { deviceId: { exact: deviceId }, ...res, facingMode: { ideal: 'environment' } }, audio: false }
     : { video: { ...res, facingMode: { ideal: 'environment' } }, audio: false };
 
-  // Plain preview first
+  // One stream feeds both the preview and the decoder
   try {
     plainStream = await navigator.mediaDevices.getUserMedia(constraints);
     const track = plainStream.getVideoTracks()[0];
@@ -265,48 +833,12 @@ async function startScanner() {
     return;
   }
 
-  // Quagga with tuned params: larger patch, no halfSample, analyze center box
-  const qConstraints = { ...constraints.video };
-  Quagga.init({
-    inputStream: {
-      type: "LiveStream",
-      target: preview,
-      constraints: qConstraints,
-      area: { // scan only the center region (matches dashed guide)
-        top: "10%", right: "10%", left: "10%", bottom: "10%"
-      }
-    },
-    decoder: {
-      readers: [
-        "code_128_reader","ean_reader","ean_8_reader","upc_reader","upc_e_reader",
-        "code_39_reader","code_39_vin_reader","codabar_reader","i2of5_reader","2of5_reader","code_93_reader"
-      ]
-    },
-    locate: true,
-    numOfWorkers: 0,                  // mobile quirk
-    locator: { patchSize: "x-large", halfSample: false }
-  }, (err) => {
-    if (err) {
-      console.error(err);
-      setLast('Scanner init failed. Using camera preview only.');
-      return;
-    }
-    Quagga.start();
-    quaggaRunning = true;
-    try { currentStreamTrack = Quagga.cameraAccess.getActiveTrack(); } catch(_) {}
-    setLast('Scanner started. Point a barcode at the center box.');
-  });
-
-  Quagga.onDetected(async (data) => {
-    const sku = (data?.codeResult?.code || "").trim();
-    if (!sku) return;
-    await recordScan(sku);
-  });
+  currentStreamTrack = plainStream.getVideoTracks()[0];
+  await startDecoding();
 }
 
 function stopScanner() {
-  try { Quagga.stop(); } catch(_) {}
-  quaggaRunning = false;
+  stopDecoding();
   currentStreamTrack = null;
   if (plainStream) { plainStream.getTracks().forEach(t=>t.stop()); plainStream=null; }
   preview.srcObject = null;
@@ -330,6 +862,114 @@ startBtn.onclick = startScanner;
 stopBtn.onclick = stopScanner;
 flashBtn.onclick = toggleTorch;
 
+/* ───────── Decoding ───────── */
+// Native BarcodeDetector where the browser has it, else a worker decoding downscaled crops of
+// the guide box. Formats, frame interval, crop size and debounce come from /api/config.
+const DECODER_DEFAULTS = { profile: 'all', formats: ['ean_13','ean_8','upc_a','upc_e','code_128','code_39','code_93','codabar','itf'],
+                           interval_ms: 100, roi_max_width: 640, debounce_ms: 1500 };
+const roiCanvas = document.createElement('canvas');
+const roiCtx = roiCanvas.getContext('2d', { willReadFrequently: true });
+let decoder = null, decodeTimer = null, decodeGen = 0, roi = null;
+let lastCode = null, lastSeen = 0;
+addEventListener('resize', () => { roi = null; });
+
+async function loadDecoderConfig() {
+  return { ...DECODER_DEFAULTS, ...(await loadServerConfig()).decoder };
+}
+
+async function createDecoder(cfg) {
+  if ('BarcodeDetector' in window) {
+    try {
+      const supported = await BarcodeDetector.getSupportedFormats();
+      const formats = cfg.formats.filter(f => supported.includes(f));
+      if (formats.length) {
+        const detector = new BarcodeDetector({ formats });
+        return { kind: 'native', decode: async () => (await detector.detect(roiCanvas))[0]?.rawValue || null, close() {} };
+      }
+    } catch(_) {}
+  }
+  // One frame in flight at a time, so a single pending reply is enough
+  const worker = new Worker('__DECODER_WORKER_URL__');
+  let pending = null, failed = null;
+  const settle = v => { const p = pending; pending = null; p?.(v); };
+  worker.onmessage = e => settle(e.data);
+  worker.onerror = e => { e.preventDefault(); failed = { error: e.message || 'decoder worker failed' }; settle(failed); };
+  worker.postMessage({ type: 'init', formats: cfg.formats });
+  return {
+    kind: 'worker',
+    decode: () => new Promise((res, rej) => {
+      if (failed) return rej(new Error(failed.error));
+      const { width, height } = roiCanvas;
+      const data = roiCtx.getImageData(0, 0, width, height).data;
+      pending = r => r.error ? rej(new Error(r.error)) : res(r.code);
+      worker.postMessage({ type: 'decode', width, height, data: data.buffer }, [data.buffer]);
+    }),
+    close() { worker.terminate(); settle({ error: 'stopped' }); },
+  };
+}
+
+// The dashed guide in video pixels; the preview letterboxes the frame (object-fit: contain)
+function guideRect() {
+  const vw = preview.videoWidth, vh = preview.videoHeight;
+  const v = preview.getBoundingClientRect(), g = guide.getBoundingClientRect();
+  const s = Math.min(v.width / vw, v.height / vh);
+  const ox = v.left + (v.width - vw * s) / 2, oy = v.top + (v.height - vh * s) / 2;
+  const x = Math.max(0, (g.left - ox) / s), y = Math.max(0, (g.top - oy) / s);
+  const w = Math.min(vw - x, g.width / s), h = Math.min(vh - y, g.height / s);
+  return (s > 0 && w > 0 && h > 0) ? { x, y, w, h } : { x: 0, y: 0, w: vw, h: vh };
+}
+
+// Copies the guide box of the current frame into roiCanvas, no wider than maxWidth
+function grabRoi(maxWidth) {
+  roi = roi || guideRect();
+  const scale = Math.min(1, maxWidth / roi.w);
+  const w = Math.round(roi.w * scale), h = Math.round(roi.h * scale);
+  if (roiCanvas.width !== w || roiCanvas.height !== h) { roiCanvas.width = w; roiCanvas.height = h; }
+  roiCtx.drawImage(preview, roi.x, roi.y, roi.w, roi.h, 0, 0, w, h);
+}
+
+// A code still in view keeps extending its window, so holding a barcode counts it once
+function acceptRead(code, debounceMs) {
+  const now = performance.now();
+  const dup = code === lastCode && now - lastSeen < debounceMs;
+  lastCode = code; lastSeen = now;
+  return !dup;
+}
+
+async function startDecoding() {
+  const gen = ++decodeGen;
+  const cfg = await loadDecoderConfig();
+  let dec;
+  try { dec = await createDecoder(cfg); }
+  catch (e) { console.error(e); setLast('Scanner init failed. Using camera preview only.'); return; }
+  if (gen !== decodeGen) { dec.close(); return; }
+  decoder = dec; roi = null;
+  setLast(`Scanner started (${dec.kind === 'native' ? 'native' : 'worker'} decoder). Point a barcode at the center box.`);
+  const tick = async () => {
+    const t0 = performance.now();
+    if (!document.hidden && preview.readyState >= 2 && preview.videoWidth) {
+      try {
+        grabRoi(cfg.roi_max_width);
+        const code = ((await dec.decode()) || '').trim();
+        if (gen !== decodeGen) return;
+        if (code && acceptRead(code, cfg.debounce_ms)) recordScan(code);
+      } catch (e) {
+        if (gen !== decodeGen) return;
+        console.error(e); setLast('Decoder stopped: ' + e.message); stopDecoding(); return;
+      }
+    }
+    // Fixed cadence, never a backlog: the next frame is grabbed only after this one is decoded
+    decodeTimer = setTimeout(tick, Math.max(0, cfg.interval_ms - (performance.now() - t0)));
+  };
+  tick();
+}
+
+function stopDecoding() {
+  decodeGen++;
+  clearTimeout(decodeTimer); decodeTimer = null;
+  if (decoder) { decoder.close(); decoder = null; }
+}
+
 /* ───────── Manual add ───────── */
 document.getElementById('addManual').onclick = async () => {
   const v = document.getElementById('manualSku').value.trim();
@@ -339,11 +979,21 @@ document.getElementById('addManual').onclick = async () => {
 };
 
 /* ───────── Sync logic ───────── */
+// Stable per-install id; with the IndexedDB id it makes every upload idempotent server-side
+function deviceId() {
+  let id = localStorage.getItem('inv_device_id');
+  if (!id) {
+    id = (crypto.randomUUID && crypto.randomUUID()) || (Date.now().toString(36) + Math.random().toString(36).slice(2));
+    localStorage.setItem('inv_device_id', id);
+  }
+  return id;
+}
+
 async function recordScan(sku) {
   const ts = new Date().toISOString();
-  await idbAddScan(sku, 1, ts, false);
+  const agg = await idbAddScan(sku, 1, ts, false);
   setLast(`Last scan: ${sku} @ ${ts}`);
-  refreshLocalAgg();
+  if (agg) renderAggRow(agg);
   if (navigator.onLine) await trySync();
 }
 
@@ -355,43 +1005,229 @@ async function trySync() {
   await pushNow();
 }
 
-async function pushNow() {
-  const unsynced = await idbGetAll(true);
-  if (!unsynced.length) { setSyncStatus('Nothing to sync'); return; }
-  setSyncStatus(`Syncing ${unsynced.length}…`);
+// Compact upload: SKU dictionary + index/count columns + timestamps as epoch ms deltas
+function toColumnar(records) {
+  const skus = [], skuIndex = new Map(), ids = [], sku_idx = [], counts = [], dts = [];
+  let prev = null;
+  for (const r of records) {
+    let k = skuIndex.get(r.sku);
+    if (k === undefined) { k = skus.length; skus.push(r.sku); skuIndex.set(r.sku, k); }
+    const t = Date.parse(r.ts);
+    ids.push(r.id); sku_idx.push(k); counts.push(r.count); dts.push(prev === null ? 0 : t - prev);
+    prev = t;
+  }
+  return { ids, skus, sku_idx, counts, t0: records.length ? Date.parse(records[0].ts) : 0, dt: dts };
+}
+
+async function encodeUpload(records) {
+  const json = JSON.stringify({ device_id: deviceId(), columnar: toColumnar(records) });
+  const headers = { 'Content-Type': 'application/json' };
+  if (json.length < 1024 || typeof CompressionStream === 'undefined') return { headers, body: json };
+  const gz = new Blob([json]).stream().pipeThrough(new CompressionStream('gzip'));
+  return { headers: { ...headers, 'Content-Encoding': 'gzip' }, body: await new Response(gz).arrayBuffer() };
+}
+
+// Sync and decoder knobs come from the server (/api/config); last known copy is kept for offline starts
+const SYNC_DEFAULTS = { chunk_size: 500, concurrency: 2, backoff_base_ms: 1000, backoff_max_ms: 30000, max_attempts: 5,
+                        compact_after_hours: 72, keep_synced_records: 2000 };
+let serverConfig = null;
+
+async function loadServerConfig() {
+  if (serverConfig) return serverConfig;
   try {
-    const payload = unsynced.map(r => ({ id: r.id, sku: r.sku, count: r.count, timestamp: r.ts }));
-    const res = await fetch('/api/scan', { method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({ scans: payload }) });
-    if (!res.ok) throw new Error('Server error');
-    const done = await res.json();
-    await idbMarkSynced(done.synced_ids || []);
-    setSyncStatus(`Synced ${done.synced_ids?.length || 0}`);
-    refreshLocalAgg();
-    await loadServer();
-  } catch (e) {
-    setSyncStatus('Sync failed (offline?)');
+    const cfg = await (await fetch('/api/config')).json();
+    if (cfg && cfg.sync) {
+      serverConfig = cfg;
+      localStorage.setItem('inv_config', JSON.stringify(cfg));
+      return cfg;
+    }
+  } catch(_) {}
+  try { return JSON.parse(localStorage.getItem('inv_config') || '{}'); }
+  catch(_) { return {}; }
+}
+
+async function loadSyncConfig() {
+  return { ...SYNC_DEFAULTS, ...(await loadServerConfig()).sync };
+}
+
+const sleep = ms => new Promise(r => setTimeout(r, ms));
+
+// Posts one chunk, retrying transient failures (network, 408/429/5xx) with jittered exponential backoff
+async function postChunk(chunk, cfg) {
+  for (let attempt = 0; ; attempt++) {
+    let res = null;
+    try {
+      const { headers, body } = await encodeUpload(chunk);
+      res = await fetch('/api/scan', { method:'POST', headers, body });
+      if (res.ok) {
+        const done = await res.json();
+        if (Array.isArray(done.synced_ids)) return done;  // else: service worker's offline stub
+      }
+    } catch(_) {}
+    if (res && res.status >= 400 && res.status < 500 && res.status !== 408 && res.status !== 429) {
+      throw new Error(`Rejected (${res.status})`);
+    }
+    if (attempt + 1 >= cfg.max_attempts) throw new Error('Gave up');
+    const retryAfter = Number(res?.headers.get('Retry-After')) * 1000;
+    const backoff = Math.min(cfg.backoff_max_ms, cfg.backoff_base_ms * 2 ** attempt);
+    await sleep(retryAfter || backoff * (0.5 + Math.random() / 2));
   }
 }
 
+// Keeps on-device storage bounded; failures are harmless, the next pass retries
+async function compactLocal(cfg) {
+  try { await idbCompact(cfg.compact_after_hours, cfg.keep_synced_records); } catch(_) {}
+}
+
+let pushing = null;
+function pushNow() {
+  // One pass at a time; a click during a pass just waits for it
+  if (!pushing) pushing = pushAll().finally(() => { pushing = null; });
+  return pushing;
+}
+
+// Scans the server refused stay on the device, out of the sync queue, until "Clear local"
+async function rejectedNote() {
+  const bad = await idbGetRejected();
+  if (!bad.length) return '';
+  const shown = bad.slice(0, 5).map(r => `${r.sku.length > 24 ? r.sku.slice(0, 24) + '…' : r.sku} (${r.error})`);
+  return ` · rejected by server: ${shown.join(', ')}${bad.length > 5 ? ` and ${bad.length - 5} more` : ''}`;
+}
+
+async function pushAll() {
+  const unsynced = await idbGetAll(true);
+  if (!unsynced.length) { setSyncStatus('Nothing to sync' + await rejectedNote()); return; }
+  const cfg = await loadSyncConfig();
+  const chunks = [];
+  for (let i = 0; i < unsynced.length; i += cfg.chunk_size) chunks.push(unsynced.slice(i, i + cfg.chunk_size));
+  let synced = 0, failed = 0;
+  const unknown = new Set();  // SKUs the server's catalog does not have
+  setSyncStatus(`Syncing ${unsynced.length}…`);
+
+  // Bounded parallelism: each runner takes the next chunk and marks it synced as soon as it lands
+  const runner = async () => {
+    for (let chunk; (chunk = chunks.shift()); ) {
+      try {
+        const done = await postChunk(chunk, cfg);
+        await idbMarkSynced(done.synced_ids, new Map((done.rejected || []).filter(r => r.id != null).map(r => [r.id, r.error])));
+        synced += done.synced_ids.length;
+        (done.unknown_skus || []).forEach(s => unknown.add(s));
+        setSyncStatus(`Synced ${synced}/${unsynced.length}`);
+      } catch(_) { failed += chunk.length; }
+    }
+  };
+  await Promise.all(Array.from({ length: Math.max(1, cfg.concurrency) }, runner));
+
+  setSyncStatus((failed ? `Synced ${synced}, ${failed} pending (offline?)` : `Synced ${synced}`)
+                + (unknown.size ? ` · not in catalog: ${[...unknown].join(', ')}` : '') + await rejectedNote());
+  if (synced) compactLocal(cfg);
+  if (synced && !liveFeedOpen()) await syncServerDelta();
+}
+
 document.getElementById('syncBtn').onclick = pushNow;
 document.getElementById('clearLocal').onclick = async () => { await idbClearUnsynced(); refreshLocalAgg(); };
 document.getElementById('refreshServer').onclick = loadServer;
 
+const olderBtn = document.getElementById('olderServer');
+let serverCursor = null;
+let serverSeq = null;          // high-water mark of rows already merged into the table
+const serverSeen = new Set();  // seqs on screen, so a delta never duplicates a row
+const SERVER_ROWS_MAX = 500;   // one default /api/scans page; live rows push the oldest out
+
+function serverRow(r) {
+  const tr = document.createElement('tr');
+  tr.dataset.ts = r.timestamp;
+  tr.dataset.seq = r.seq;
+  tr.innerHTML = `<td>${r.sku}</td><td>${r.count}</td><td>${r.timestamp}</td>`;
+  serverSeen.add(r.seq);
+  return tr;
+}
+
+function appendServerRows(data) {
+  (data || []).forEach(r => { if (!serverSeen.has(r.seq)) serverTableBody.appendChild(serverRow(r)); });
+}
+
+// Inserts delta rows at their timestamp position; rows older than the loaded page stay on older pages
+function mergeServerRows(rows) {
+  for (const r of rows) {
+    if (serverSeen.has(r.seq)) continue;
+    const after = [...serverTableBody.children].find(tr => tr.dataset.ts < r.timestamp);
+    if (after) serverTableBody.insertBefore(serverRow(r), after);
+    else if (!serverCursor) serverTableBody.appendChild(serverRow(r));
+  }
+  trimServerRows();
+}
+
+// Drops the oldest rows past SERVER_ROWS_MAX; "Load older" then resumes right after the last kept one
+function trimServerRows() {
+  if (serverTableBody.children.length <= SERVER_ROWS_MAX) return;
+  while (serverTableBody.children.length > SERVER_ROWS_MAX) {
+    serverSeen.delete(Number(serverTableBody.lastElementChild.dataset.seq));
+    serverTableBody.lastElementChild.remove();
+  }
+  const last = serverTableBody.lastElementChild.dataset;
+  serverCursor = btoa(`${last.ts}|${last.seq}`).replaceAll('+', '-').replaceAll('/', '_').replace(/=+$/, '');
+  olderBtn.disabled = false;
+}
+
+async function fetchServerPage(before) {
+  const res = await fetch('/api/scans' + (before ? `?before=${encodeURIComponent(before)}` : ''));
+  const data = await res.json();
+  serverCursor = res.headers.get('X-Next-Cursor');
+  olderBtn.disabled = !serverCursor;
+  if (!before && res.headers.get('X-High-Water-Mark')) serverSeq = Number(res.headers.get('X-High-Water-Mark'));
+  return data;
+}
+
 async function loadServer() {
   try {
-    const res = await fetch('/api/scans');
-    const data = await res.json();
+    const data = await fetchServerPage(null);
     serverTableBody.innerHTML = '';
-    (data || []).sort((a,b)=> (a.timestamp > b.timestamp ? -1 : 1)).forEach(r => {
-      const tr = document.createElement('tr');
-      tr.innerHTML = `<td>${r.sku}</td><td>${r.count}</td><td>${r.timestamp}</td>`;
-      serverTableBody.appendChild(tr);
-    });
+    serverSeen.clear();
+    appendServerRows(data);
+  } catch(e) {}
+}
+
+// Pulls only rows stored since the last mark; falls back to a full load when there is no mark yet
+async function syncServerDelta() {
+  if (serverSeq === null) return loadServer();
+  try {
+    for (;;) {
+      const res = await fetch(`/api/scans?since=${serverSeq}`);
+      if (!res.ok) return;
+      const delta = await res.json();
+      if (!Array.isArray(delta.scans)) return;  // offline fallback from the service worker
+      mergeServerRows(delta.scans);
+      serverSeq = delta.seq;
+      if (!delta.more) return;
+    }
   } catch(e) {}
 }
 
+// Live feed: rows any device stores arrive over SSE, so nothing is refetched. Only when the
+// server enables it; EventSource reconnects on its own and resumes with Last-Event-ID.
+let liveFeed = null;
+async function startLiveFeed() {
+  if (liveFeed || typeof EventSource === 'undefined') return;
+  if (!(await loadServerConfig()).stream?.enabled) return;
+  liveFeed = new EventSource('/api/stream' + (serverSeq !== null ? `?since=${serverSeq}` : ''));
+  liveFeed.addEventListener('scans', e => {
+    const d = JSON.parse(e.data);
+    mergeServerRows(d.scans);
+    serverSeq = Math.max(serverSeq || 0, d.seq);
+  });
+  liveFeed.addEventListener('reset', () => loadServer());
+}
+function liveFeedOpen() { return liveFeed && liveFeed.readyState === EventSource.OPEN; }
+
+olderBtn.onclick = async () => {
+  if (!serverCursor) return;
+  try { appendServerRows(await fetchServerPage(serverCursor)); } catch(e) {}
+};
+
 refreshLocalAgg();
-loadServer();
+loadServer().then(startLiveFeed);
+loadSyncConfig().then(compactLocal);
 
 // SW→page message hook for background sync fallback
 navigator.serviceWorker?.addEventListener('message', (ev)=>{
@@ -407,26 +1243,32 @@ ensurePermissionAndDeviceList();
 
 # ───────────────────────── Service Worker ─────────────────────────
 SERVICE_WORKER_JS = """
+const CACHE = 'inv-scanner-__BUILD__';
 self.addEventListener('install', event => {
   event.waitUntil(
-    caches.open('inv-scanner-v1').then(cache => cache.addAll([
-      '/', '/manifest.json'
+    caches.open(CACHE).then(cache => cache.addAll([
+      '/', '__MANIFEST_URL__', '__DECODER_WORKER_URL__'
     ]))
   );
   self.skipWaiting();
 });
 self.addEventListener('activate', event => {
-  event.waitUntil(self.clients.claim());
+  // A new build ships a new CACHE name; drop the old copies of the page
+  event.waitUntil(
+    caches.keys().then(keys => Promise.all(keys.filter(k => k !== CACHE).map(k => caches.delete(k))))
+      .then(() => self.clients.claim())
+  );
 });
 self.addEventListener('fetch', event => {
   const url = new URL(event.request.url);
+  if (url.pathname === '/api/stream') return;  // long-lived; let the browser handle it
   if (url.pathname.startsWith('/api/')) {
     event.respondWith(fetch(event.request).catch(() => new Response(JSON.stringify([]), {headers:{'Content-Type':'application/json'}})));
   } else {
     event.respondWith(
       caches.match(event.request).then(cached => cached || fetch(event.request).then(resp => {
         const copy = resp.clone();
-        caches.open('inv-scanner-v1').then(c => c.put(event.request, copy));
+        caches.open(CACHE).then(c => c.put(event.request, copy));
         return resp;
       }).catch(() => cached))
     );
@@ -445,6 +1287,37 @@ async function pushScans(){
 }
 """
 
+# ───────────────────────── Decoder worker ─────────────────────────
+# Fallback for browsers without BarcodeDetector: decodes the RGBA crops of the guide box the
+# page posts, off the main thread. Formats use the BarcodeDetector names from /api/config.
+DECODER_WORKER_JS = """
+importScripts('https://unpkg.com/@zxing/library@0.20.0/umd/index.min.js');
+const FORMATS = { ean_13: 'EAN_13', ean_8: 'EAN_8', upc_a: 'UPC_A', upc_e: 'UPC_E', code_128: 'CODE_128',
+                  code_39: 'CODE_39', code_93: 'CODE_93', codabar: 'CODABAR', itf: 'ITF' };
+let reader = null, luma = null;
+function configure(formats) {
+  const hints = new Map();
+  hints.set(ZXing.DecodeHintType.POSSIBLE_FORMATS,
+            formats.map(f => ZXing.BarcodeFormat[FORMATS[f]]).filter(f => f !== undefined));
+  reader = new ZXing.MultiFormatReader();
+  reader.setHints(hints);
+}
+function decode(width, height, rgba) {
+  if (!luma || luma.length !== width * height) luma = new Uint8ClampedArray(width * height);
+  for (let i = 0, j = 0; i < luma.length; i++, j += 4) luma[i] = (rgba[j] * 77 + rgba[j + 1] * 150 + rgba[j + 2] * 29) >> 8;
+  const bitmap = new ZXing.BinaryBitmap(new ZXing.HybridBinarizer(new ZXing.RGBLuminanceSource(luma, width, height)));
+  // ZXing reports "no barcode" (and failed checksums) by throwing
+  try { return reader.decodeWithState(bitmap).getText(); } catch (_) { return null; }
+}
+self.onmessage = e => {
+  const m = e.data;
+  if (m.type === 'init') { configure(m.formats); return; }
+  const t0 = performance.now();
+  const code = decode(m.width, m.height, new Uint8ClampedArray(m.data));
+  postMessage({ code, ms: performance.now() - t0 });
+};
+"""
+
 # ───────────────────────── Manifest ─────────────────────────
 MANIFEST_JSON = {
     "name": "Inventory Scanner",
@@ -457,75 +1330,1883 @@ MANIFEST_JSON = {
 }
 
 
+class StaticAsset:
+    """
+    An in-memory asset with its ETag and gzip/brotli variants computed once at startup.
+    Conditional requests are answered with 304 before any body is chosen.
+    """
+
+    def __init__(self, body, content_type, cache_control="no-cache"):
+        raw = body.encode() if isinstance(body, str) else body
+        self.etag = hashlib.sha256(raw).hexdigest()[:20]
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.variants = {"gzip": gzip.compress(raw, 9, mtime=0)}
+        if brotli is not None:
+            self.variants["br"] = brotli.compress(raw, quality=11)
+        self.raw = raw
+
+    def response(self):
+        headers = {"Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        if request.if_none_match.contains_weak(self.etag):
+            resp = Response(status=304, headers=headers)
+        else:
+            encoding = next((e for e in ("br", "gzip") if e in self.variants and request.accept_encodings[e]), None)
+            resp = Response(self.variants.get(encoding, self.raw), content_type=self.content_type, headers=headers)
+            if encoding:
+                resp.headers["Content-Encoding"] = encoding
+        # Weak: the same validator covers every encoding of the content.
+        resp.set_etag(self.etag, weak=True)
+        return resp
+
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+MANIFEST_ASSET = StaticAsset(json.dumps(MANIFEST_JSON), "application/manifest+json")
+# Content-addressed URL: the page links here, so browsers never revalidate it.
+MANIFEST_URL = f"/manifest.{MANIFEST_ASSET.etag}.json"
+DECODER_WORKER_ASSET = StaticAsset(DECODER_WORKER_JS, "application/javascript; charset=utf-8", IMMUTABLE)
+DECODER_WORKER_URL = f"/decoder-worker.{DECODER_WORKER_ASSET.etag}.js"
+INDEX_ASSET = StaticAsset(
+    INDEX_HTML.replace("__MANIFEST_URL__", MANIFEST_URL).replace("__DECODER_WORKER_URL__", DECODER_WORKER_URL),
+    "text/html; charset=utf-8",
+)
+SW_ASSET = StaticAsset(
+    SERVICE_WORKER_JS.replace("__BUILD__", INDEX_ASSET.etag[:12]).replace("__MANIFEST_URL__", MANIFEST_URL)
+    .replace("__DECODER_WORKER_URL__", DECODER_WORKER_URL),
+    "application/javascript; charset=utf-8",
+)
+
+
 @app.get("/")
 def index():
-    resp = make_response(INDEX_HTML)
-    resp.headers["Content-Type"] = "text/html; charset=utf-8"
-    return resp
+    return INDEX_ASSET.response()
 
 
 @app.get("/service-worker.js")
 def sw():
-    resp = make_response(SERVICE_WORKER_JS)
-    resp.headers["Content-Type"] = "application/javascript; charset=utf-8"
-    return resp
+    return SW_ASSET.response()
 
 
 @app.get("/manifest.json")
 def manifest():
-    return jsonify(MANIFEST_JSON)
+    return MANIFEST_ASSET.response()
 
 
-# ───────────────────────── API ─────────────────────────
-@app.post("/api/scan")
-def api_scan():
+@app.get("/manifest.<digest>.json")
+def manifest_immutable(digest):
+    if digest != MANIFEST_ASSET.etag:
+        return jsonify({"error": "not_found"}), 404
+    resp = MANIFEST_ASSET.response()
+    resp.headers["Cache-Control"] = IMMUTABLE
+    return resp
+
+
+@app.get("/decoder-worker.<digest>.js")
+def decoder_worker(digest):
+    if digest != DECODER_WORKER_ASSET.etag:
+        return jsonify({"error": "not_found"}), 404
+    return DECODER_WORKER_ASSET.response()
+
+
+# ───────────────────────── Read cache ─────────────────────────
+def dumps(obj):
+    """JSON bytes via orjson when installed; naive datetimes are emitted as UTC either way."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC)
+    return json.dumps(obj, separators=(",", ":"), default=_json_default).encode()
+
+
+def _json_default(o):
+    if isinstance(o, dt.datetime):
+        return o.replace(tzinfo=dt.timezone.utc).isoformat()
+    raise TypeError(f"{type(o).__name__} is not JSON serializable")
+
+
+class ResponseCache:
     """
-    Accepts {"scans":[{"id":<localId>,"sku":"...", "count":1, "timestamp":"ISO"}]}
-    Returns {"synced_ids":[<localId>...]}
+    Small LRU of serialized (body, headers) responses, bounded by total body bytes.
+    Each entry records the scan high-water mark it was built at and is only served while
+    that is still current, which keeps workers that did not see the ingest consistent;
+    local ingests also clear it outright.
     """
-    data = request.get_json(silent=True) or {}
-    scans = data.get("scans", [])
-    if not isinstance(scans, list):
-        return jsonify({"error": "bad payload"}), 400
 
-    session = SessionLocal()
-    synced_ids = []
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is None or hit[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            return hit[1]
+
+    def put(self, key, version, value):
+        size = len(value[0])
+        if size > self.max_bytes // 4:  # one huge page would evict everything else
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[1][0])
+            self._entries[key] = (version, value)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted[0])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+# Per worker; keys are raw query strings, so distinct cursors and windows each take an entry.
+SCANS_CACHE_MAX_BYTES = int(os.getenv("SCANS_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+scans_cache = ResponseCache(SCANS_CACHE_MAX_BYTES)
+
+
+# ───────────────────────── Ingestion ─────────────────────────
+SKU_MAX_LEN = Scan.__table__.c.sku.type.length
+ORIGIN_ID_MAX_LEN = Scan.__table__.c.client_id.type.length
+COUNT_MAX = 2 ** 31 - 1  # scans.count and products.expected_qty are 32-bit INTEGERs on PostgreSQL
+COPY_MIN_ROWS = 500  # below this, COPY setup costs more than a multi-row INSERT
+
+
+def _parse_ts(raw):
+    """Client ISO-8601 timestamp -> naive UTC datetime (server time if missing/unparseable)."""
+    if isinstance(raw, dt.datetime):  # already decoded, e.g. from a columnar upload
+        return raw
+    if isinstance(raw, str):
+        try:
+            ts = dt.datetime.fromisoformat(raw.replace("Z", "+00:00"))
+            if ts.tzinfo is not None:
+                ts = ts.astimezone(dt.timezone.utc).replace(tzinfo=None)
+        except (ValueError, OverflowError):  # OverflowError: offset shifts it past year 1 or 9999
+            return dt.datetime.utcnow()
+        return ts
+    return dt.datetime.utcnow()
+
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(64 * 1024 * 1024)))  # after decompression
+MAX_BATCH_ROWS = int(os.getenv("MAX_BATCH_ROWS", "0"))  # 0: no per-request row limit
+_EPOCH = dt.datetime(1970, 1, 1)
+
+
+class PayloadTooLarge(Exception):
+    pass
+
+
+def read_upload():
+    """
+    The request body as parsed JSON, gunzipping Content-Encoding: gzip bodies with a cap
+    on the inflated size. Returns {} for bodies that are not valid JSON.
+    """
+    raw = request.get_data(cache=False)
+    if request.content_encoding == "gzip":
+        inflater = zlib.decompressobj(31)
+        try:
+            raw = inflater.decompress(raw, MAX_UPLOAD_BYTES)
+        except zlib.error:
+            return {}
+        if inflater.unconsumed_tail:
+            raise PayloadTooLarge()
     try:
-        for s in scans:
-            sku = str(s.get("sku", "")).strip()
-            count = int(s.get("count", 1) or 1)
-            ts_raw = s.get("timestamp")
-            try:
-                ts = dt.datetime.fromisoformat(ts_raw.replace("Z", "+00:00")) if isinstance(ts_raw, str) else dt.datetime.utcnow()
-            except Exception:
-                ts = dt.datetime.utcnow()
-            if not sku:
-                continue
-            session.add(Scan(sku=sku, count=count, timestamp=ts))
-            if "id" in s:
-                synced_ids.append(s["id"])
-        session.commit()
-        return jsonify({"synced_ids": synced_ids})
-    except Exception as e:
-        session.rollback()
-        return jsonify({"error": "server_error", "detail": str(e)}), 500
-    finally:
-        session.close()
+        data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
 
 
-@app.get("/api/scans")
-def api_scans():
-    session = SessionLocal()
+def expand_columnar(col):
+    """
+    Decodes the compact upload format into row dicts for normalize_batch():
+      {"ids":[...], "skus":[<distinct sku>...], "sku_idx":[...], "counts":[...],
+       "t0":<epoch ms of first row>, "dt":[<ms since previous row>...]}
+    Raises ValueError if the columns are inconsistent or a timestamp is out of range.
+    """
+    ids, skus, idx, counts, deltas = (col.get(k) for k in ("ids", "skus", "sku_idx", "counts", "dt"))
+    if not all(isinstance(v, list) for v in (ids, skus, idx, counts, deltas)):
+        raise ValueError("missing column")
+    if not len(ids) == len(idx) == len(counts) == len(deltas):
+        raise ValueError("column lengths differ")
+    rows = []
     try:
-        rows = session.query(Scan).order_by(Scan.timestamp.desc()).limit(500).all()
-        return jsonify([
-            {"sku": r.sku, "count": r.count, "timestamp": r.timestamp.replace(tzinfo=dt.timezone.utc).isoformat()}
-            for r in rows
-        ])
-    finally:
-        session.close()
+        t = int(col.get("t0") or 0)
+        for local_id, k, count, delta in zip(ids, idx, counts, deltas):
+            if not 0 <= k < len(skus):
+                raise ValueError("sku index out of range")
+            t += int(delta)
+            rows.append({"id": local_id, "sku": skus[k], "count": count, "timestamp": _EPOCH + dt.timedelta(milliseconds=t)})
+    except OverflowError:  # t0/dt beyond what a datetime can hold
+        raise ValueError("timestamp out of range") from None
+    return rows
+
+
+def normalize_batch(scans, device_id=None):
+    """
+    Validates a whole upload before touching the database.
+    Returns (rows, synced_ids, rejected): rows are plain dicts ready for a Core insert,
+    rejected is [{"index", "id", "error"}] for rows the client should not retry as-is.
+    """
+    if device_id is not None:
+        device_id = str(device_id).strip()[:ORIGIN_ID_MAX_LEN] or None
+    rows, synced_ids, rejected = [], [], []
+    for i, s in enumerate(scans):
+        if not isinstance(s, dict):
+            rejected.append({"index": i, "id": None, "error": "not_an_object"})
+            continue
+        local_id = s.get("id")
+        sku = str(s.get("sku", "")).strip()
+        if not sku:
+            rejected.append({"index": i, "id": local_id, "error": "missing_sku"})
+            continue
+        if len(sku) > SKU_MAX_LEN:
+            rejected.append({"index": i, "id": local_id, "error": "sku_too_long"})
+            continue
+        try:
+            count = int(s.get("count", 1) or 1)
+        except (TypeError, ValueError, OverflowError):
+            count = None
+        if count is None or not 1 <= count <= COUNT_MAX:
+            rejected.append({"index": i, "id": local_id, "error": "bad_count"})
+            continue
+        if local_id is not None and len(str(local_id)) > ORIGIN_ID_MAX_LEN:
+            rejected.append({"index": i, "id": local_id, "error": "id_too_long"})
+            continue
+        rows.append({
+            "sku": sku,
+            "count": count,
+            "timestamp": _parse_ts(s.get("timestamp")),
+            "device_id": device_id,
+            "client_id": str(local_id) if device_id and local_id is not None else None,
+        })
+        if "id" in s:
+            synced_ids.append(local_id)
+    return rows, synced_ids, rejected
+
+
+def _copy_escape(value):
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+_COPY_COLUMNS = ("sku", "count", "timestamp", "device_id", "client_id")
+
+
+def _copy_scans(conn, rows):
+    """
+    PostgreSQL COPY into a session-local staging table, then one INSERT ... SELECT so
+    the dedup constraint still applies. Runs on the connection's own transaction.
+    """
+    buf = io.StringIO()
+    for r in rows:
+        buf.write("\t".join(_copy_escape(r[c] if c != "timestamp" else r[c].isoformat()) for c in _COPY_COLUMNS))
+        buf.write("\n")
+    buf.seek(0)
+    cols = ", ".join(_COPY_COLUMNS)
+    with conn.connection.dbapi_connection.cursor() as cur:
+        cur.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS scans_stage "
+            "(sku varchar(128), count integer, timestamp timestamp, device_id varchar(64), client_id varchar(64)) "
+            "ON COMMIT DELETE ROWS"
+        )
+        # A group commit stages several batches in one transaction; drop the previous one's rows.
+        cur.execute("TRUNCATE scans_stage")
+        cur.copy_expert(f"COPY scans_stage ({cols}) FROM STDIN", buf)
+    return conn.execute(text(
+        f"INSERT INTO scans ({cols}) SELECT {cols} FROM scans_stage "
+        f"ON CONFLICT ({', '.join(SCAN_DEDUP_COLUMNS)}) DO NOTHING RETURNING id, sku, count, timestamp"
+    )).mappings().all()
+
+
+# A partitioned table's unique constraints must include the partition key, so there the
+# dedup key also covers the timestamp (clients resend a scan with its original one).
+SCAN_DEDUP_COLUMNS = (
+    ("device_id", "client_id", "timestamp") if SCANS_PARTITIONED and engine.dialect.name == "postgresql"
+    else ("device_id", "client_id")
+)
+
+
+# Multi-row VALUES chunk sizes: a batch is split into powers of two up to this, so each
+# table only ever sees a handful of distinct statements (7 at 64) in the compiled cache.
+UPSERT_CHUNK_ROWS = 64
+
+
+@functools.lru_cache(maxsize=None)
+def _values_upsert(table, columns, n, tail, returning=()):
+    """
+    INSERT INTO table (columns) VALUES (...) x n, then tail (the ON CONFLICT clause), as
+    one text() statement. The dialect insert() constructs opt out of SQLAlchemy's
+    compiled cache, so their ON CONFLICT forms were recompiled on every execute; plain
+    text with typed binds is built here once per shape and compiled once per process.
+    """
+    values = ", ".join("(" + ", ".join(f":{c}_{i}" for c in columns) + ")" for i in range(n))
+    sql = f"INSERT INTO {table.name} ({', '.join(columns)}) VALUES {values} {tail}"
+    stmt = text(sql).bindparams(*(bindparam(f"{c}_{i}", type_=table.c[c].type) for i in range(n) for c in columns))
+    return stmt.columns(*(table.c[c] for c in returning)) if returning else stmt
+
+
+def _upsert_chunks(rows):
+    i = 0
+    while i < len(rows):
+        n = min(UPSERT_CHUNK_ROWS, 1 << ((len(rows) - i).bit_length() - 1))
+        yield rows[i:i + n]
+        i += n
+
+
+def execute_upsert(conn, table, columns, rows, tail, returning=()):
+    """Runs _values_upsert over rows in chunks; returns the RETURNING rows, if any."""
+    out = []
+    for chunk in _upsert_chunks(rows):
+        params = {f"{c}_{i}": r[c] for i, r in enumerate(chunk) for c in columns}
+        result = conn.execute(_values_upsert(table, columns, len(chunk), tail, returning), params)
+        if returning:
+            out.extend(result.mappings().all())
+    return out
+
+
+def _scan_insert(conn, rows):
+    """Inserts scans, silently skipping (device_id, client_id) pairs the server already stored."""
+    return execute_upsert(
+        conn, Scan.__table__, _COPY_COLUMNS, rows,
+        f"ON CONFLICT ({', '.join(SCAN_DEDUP_COLUMNS)}) DO NOTHING RETURNING id, sku, count, timestamp",
+        returning=("id", "sku", "count", "timestamp"),
+    )
+
+
+def _dialect_insert(table):
+    # Imported on first use: the PostgreSQL dialect module alone adds ~70ms to worker boot.
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+
+def _least():
+    return "least" if engine.dialect.name == "postgresql" else "min"
+
+
+def _greatest():
+    return "greatest" if engine.dialect.name == "postgresql" else "max"
+
+
+def accumulate(conn, table, key_cols, deltas):
+    """
+    Adds {key: (count, first_seen, last_seen)} into a counter table shaped like
+    sku_totals: total_count is summed, first_seen/last_seen widened. Keys are applied
+    in sorted order so concurrent writers take row locks in the same order.
+    """
+    if not deltas:
+        return
+    rows = [
+        {**dict(zip(key_cols, key)), "total_count": n, "first_seen": first, "last_seen": last}
+        for key, (n, first, last) in sorted(deltas.items())
+    ]
+    t = table.name
+    execute_upsert(conn, table, (*key_cols, "total_count", "first_seen", "last_seen"), rows, (
+        f"ON CONFLICT ({', '.join(key_cols)}) DO UPDATE SET "
+        f"total_count = {t}.total_count + excluded.total_count, "
+        f"first_seen = {_least()}({t}.first_seen, excluded.first_seen), "
+        f"last_seen = {_greatest()}({t}.last_seen, excluded.last_seen)"
+    ))
+
+
+def fold(deltas, key, count, ts):
+    """Merges one scan into an accumulate() delta map."""
+    prev = deltas.get(key)
+    deltas[key] = (count, ts, ts) if prev is None else (prev[0] + count, min(prev[1], ts), max(prev[2], ts))
+
+
+def update_totals(conn, inserted):
+    deltas = {}
+    for r in inserted:
+        fold(deltas, (r["sku"],), r["count"], r["timestamp"])
+    accumulate(conn, SkuTotal.__table__, ("sku",), deltas)
+
+
+def _archived_deltas(key):
+    """
+    accumulate() deltas over every archived scan, keyed by key(row), read back from the
+    archive files. Raises OSError if one is missing, so a rebuild never drops them silently.
+    """
+    deltas = {}
+    for batch in read_archives(archives_between(None, None), None, None):
+        for r in batch:
+            fold(deltas, key(r), r.count, r.timestamp)
+    return deltas
+
+
+def rebuild_totals(conn):
+    """Recomputes sku_totals from scans plus the archives; returns the number of SKUs written."""
+    if conn.dialect.name == "postgresql":
+        # Blocks concurrent ingests' upserts until the rebuilt rows are committed.
+        conn.execute(text("LOCK TABLE sku_totals IN EXCLUSIVE MODE"))
+    t = SkuTotal.__table__
+    conn.execute(t.delete())
+    agg = select(
+        Scan.sku, func.sum(Scan.count), func.min(Scan.timestamp), func.max(Scan.timestamp)
+    ).group_by(Scan.sku)
+    conn.execute(t.insert().from_select(["sku", "total_count", "first_seen", "last_seen"], agg))
+    accumulate(conn, t, ("sku",), _archived_deltas(lambda r: (r.sku,)))
+    return conn.execute(select(func.count()).select_from(t)).scalar_one()
+
+
+def bucket_start(granularity, ts):
+    if granularity == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _bucket_expr(granularity, col):
+    """SQL twin of bucket_start(); on SQLite it must match SQLAlchemy's DATETIME text format."""
+    if engine.dialect.name == "postgresql":
+        return func.date_trunc(granularity, col)
+    return func.strftime("%Y-%m-%d %H:00:00.000000" if granularity == "hour" else "%Y-%m-%d 00:00:00.000000", col)
+
+
+def update_rollups(conn, inserted):
+    for granularity, model in ROLLUPS.items():
+        deltas = {}
+        for r in inserted:
+            fold(deltas, (bucket_start(granularity, r["timestamp"]), r["sku"]), r["count"], r["timestamp"])
+        accumulate(conn, model.__table__, ("bucket", "sku"), deltas)
+
+
+def rebuild_rollup(conn, granularity):
+    """Recomputes one rollup table from scans plus the archives; returns the number of buckets written."""
+    t = ROLLUPS[granularity].__table__
+    if conn.dialect.name == "postgresql":
+        conn.execute(text(f"LOCK TABLE {t.name} IN EXCLUSIVE MODE"))
+    conn.execute(t.delete())
+    bucket = _bucket_expr(granularity, Scan.timestamp)
+    agg = select(
+        bucket, Scan.sku, func.sum(Scan.count), func.min(Scan.timestamp), func.max(Scan.timestamp)
+    ).group_by(bucket, Scan.sku)
+    conn.execute(t.insert().from_select(["bucket", "sku", "total_count", "first_seen", "last_seen"], agg))
+    accumulate(conn, t, ("bucket", "sku"), _archived_deltas(lambda r: (bucket_start(granularity, r.timestamp), r.sku)))
+    return conn.execute(select(func.count()).select_from(t)).scalar_one()
+
+
+SEQ_LOCK_KEY = 0x5CA75E9  # pg_advisory_xact_lock key serializing id assignment
+
+
+def insert_scans(conn, rows):
+    """
+    Bulk upsert: COPY on PostgreSQL for large batches, multi-row VALUES otherwise.
+    Returns the rows that were actually inserted (retried duplicates are left out).
+
+    Scan.id doubles as the server sequence for delta reads (?since=). On PostgreSQL the
+    inserting transaction holds an advisory lock until commit, so ids become visible in
+    order and a reader that has seen id N can never later see a smaller one appear.
+    """
+    if not rows:
+        return []
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": SEQ_LOCK_KEY})
+    if conn.dialect.name == "postgresql" and len(rows) >= COPY_MIN_ROWS:
+        return _copy_scans(conn, rows)
+    return _scan_insert(conn, rows)
+
+
+def store_batches(batches):
+    """
+    Writes several validated batches in one transaction (one commit/fsync for all).
+    Returns the inserted rows per batch, in input order.
+    """
+    with connect() as conn, conn.begin():
+        results = [insert_scans(conn, rows) for rows in batches]
+        inserted = [r for res in results for r in res]
+        update_totals(conn, inserted)
+        update_rollups(conn, inserted)
+        if inserted:
+            notify_scans(conn)
+    if inserted:
+        scans_cache.clear()
+        stream_broker.wake()
+    metrics.inc("scan_rows_ingested_total", len(inserted))
+    metrics.inc("scan_rows_duplicate_total", sum(len(rows) for rows in batches) - len(inserted))
+    return results
+
+
+# ───────────────────────── Write-behind ingestion ─────────────────────────
+INGEST_MODE = os.getenv("INGEST_MODE", "sync")          # sync | queue
+INGEST_ACK = os.getenv("INGEST_ACK", "commit")          # commit | enqueue (queue mode only)
+INGEST_QUEUE_ROWS = int(os.getenv("INGEST_QUEUE_ROWS", "50000"))
+INGEST_FLUSH_MS = int(os.getenv("INGEST_FLUSH_MS", "50"))
+INGEST_FLUSH_ROWS = int(os.getenv("INGEST_FLUSH_ROWS", "5000"))
+INGEST_COMMIT_TIMEOUT = float(os.getenv("INGEST_COMMIT_TIMEOUT", "10"))
+
+
+class QueueFull(Exception):
+    pass
+
+
+class _PendingBatch:
+    __slots__ = ("rows", "enqueued", "done", "inserted", "error")
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.enqueued = time.monotonic()
+        self.done = threading.Event()
+        self.inserted = None
+        self.error = None
+
+
+class IngestQueue:
+    """
+    Bounded in-process buffer of validated batches. A single flusher thread per worker
+    group-commits whatever has accumulated every flush_ms or flush_rows, whichever
+    comes first. Pending rows count against max_rows until their commit finishes.
+    """
+
+    def __init__(self, max_rows, flush_ms, flush_rows):
+        self.max_rows = max_rows
+        self.flush_s = flush_ms / 1000
+        self.flush_rows = flush_rows
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._rows = 0  # queued + being committed
+        self._closed = False
+        self._thread = None
+        self._pid = None
+
+    def submit(self, rows):
+        """Enqueues a batch; raises QueueFull when it would exceed max_rows."""
+        batch = _PendingBatch(rows)
+        with self._cond:
+            if self._closed:
+                raise QueueFull("shutting down")
+            # An oversized batch is still admitted into an empty queue so it can't starve.
+            if self._rows and self._rows + len(rows) > self.max_rows:
+                raise QueueFull(f"{self._rows} rows pending")
+            self._ensure_flusher()
+            self._pending.append(batch)
+            self._rows += len(rows)
+            self._cond.notify()
+        return batch
+
+    def _ensure_flusher(self):
+        # Started lazily so each forked gunicorn worker gets its own thread.
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="ingest-flusher", daemon=True)
+            self._thread.start()
+
+    def _take(self):
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            if not self._pending:
+                return None
+            deadline = self._pending[0].enqueued + self.flush_s
+            while not self._closed and self._queued_rows() < self.flush_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            group, n = [], 0
+            while self._pending and (not group or n + len(self._pending[0].rows) <= self.flush_rows):
+                batch = self._pending.popleft()
+                group.append(batch)
+                n += len(batch.rows)
+            return group
+
+    def _queued_rows(self):
+        return sum(len(b.rows) for b in self._pending)
+
+    def _run(self):
+        while True:
+            group = self._take()
+            if group is None:
+                return
+            self._commit(group)
+            with self._cond:
+                self._rows -= sum(len(b.rows) for b in group)
+
+    def _commit(self, group):
+        try:
+            with metrics.phase("flusher", "store"):
+                results = store_batches([b.rows for b in group])
+            metrics.start_publisher()
+            for batch, inserted in zip(group, results):
+                batch.inserted = inserted
+        except Exception as e:
+            if len(group) > 1:
+                # Isolate the failing batch instead of failing everyone merged with it.
+                for batch in group:
+                    self._commit([batch])
+                return
+            group[0].error = e
+            app.logger.exception("write-behind commit failed (%d rows)", len(group[0].rows))
+        for batch in group:
+            batch.done.set()
+
+    def close(self, timeout=30):
+        """Stops accepting batches and waits for everything queued to be committed."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+
+
+ingest_queue = IngestQueue(INGEST_QUEUE_ROWS, INGEST_FLUSH_MS, INGEST_FLUSH_ROWS) if INGEST_MODE == "queue" else None
+if ingest_queue is not None:
+    atexit.register(ingest_queue.close)  # gunicorn workers exit via sys.exit on graceful shutdown
+
+
+# ───────────────────────── Catalog ─────────────────────────
+CATALOG_CACHE_SIZE = int(os.getenv("CATALOG_CACHE_SIZE", "10000"))
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", "60"))
+CATALOG_IMPORT_BATCH_ROWS = 1000
+CATALOG_MAX_REJECTED = 100  # rejected lines echoed back per import
+PRODUCT_NAME_MAX_LEN = Product.__table__.c.name.type.length
+
+
+class CatalogCache:
+    """
+    Per-process LRU of catalog lookups by SKU, unknown SKUs included, each kept for ttl
+    seconds. An import clears it in the worker that ran it; other workers pick the change
+    up when their entries expire.
+    """
+    _loaded_key = object()  # whether the catalog has any products at all
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """(True, value) for a live entry, (False, None) otherwise."""
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is None or hit[0] < time.monotonic():
+                return False, None
+            self._entries.move_to_end(key)
+            return True, hit[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+catalog_cache = CatalogCache(CATALOG_CACHE_SIZE, CATALOG_CACHE_TTL)
+_CATALOG_VERSION = select(func.max(Product.updated_at))
+
+
+def _product_json(p):
+    return {"sku": p.sku, "name": p.name, "expected_qty": p.expected_qty}
+
+
+def lookup_products(skus):
+    """{sku: product dict or None} for skus, from catalog_cache; misses in one query."""
+    out, missing = {}, []
+    for sku in skus:
+        hit, value = catalog_cache.get(sku)
+        if hit:
+            out[sku] = value
+        else:
+            missing.append(sku)
+    metrics.inc("catalog_cache_requests_total", len(out), result="hit")
+    if missing:
+        metrics.inc("catalog_cache_requests_total", len(missing), result="miss")
+        with connect() as conn:
+            found = {
+                r.sku: _product_json(r)
+                for r in conn.execute(select(Product.sku, Product.name, Product.expected_qty).where(Product.sku.in_(missing)))
+            }
+        for sku in missing:
+            out[sku] = found.get(sku)
+            catalog_cache.put(sku, out[sku])
+    return out
+
+
+def catalog_loaded():
+    """Whether any product exists; until one does, no SKU is flagged as unknown."""
+    hit, loaded = catalog_cache.get(CatalogCache._loaded_key)
+    if not hit:
+        with connect() as conn:
+            loaded = conn.execute(select(Product.sku).limit(1)).first() is not None
+        catalog_cache.put(CatalogCache._loaded_key, loaded)
+    return loaded
+
+
+def unknown_skus(rows):
+    """Sorted SKUs of validated rows that have no catalog entry."""
+    if not rows or not catalog_loaded():
+        return []
+    products = lookup_products({r["sku"] for r in rows})
+    return sorted(sku for sku, p in products.items() if p is None)
+
+
+def _catalog_row(rec):
+    sku = (rec.get("sku") or "").strip()
+    if not sku:
+        raise ValueError("missing sku")
+    if len(sku) > SKU_MAX_LEN:
+        raise ValueError("sku too long")
+    name = (rec.get("name") or "").strip() or None
+    if name is not None and len(name) > PRODUCT_NAME_MAX_LEN:
+        raise ValueError("name too long")
+    qty = (rec.get("expected_qty") or "").strip()
+    if not qty:
+        return {"sku": sku, "name": name, "expected_qty": None}
+    try:
+        expected_qty = int(qty)
+    except ValueError:
+        raise ValueError("bad expected_qty") from None
+    if not 0 <= expected_qty <= COUNT_MAX:
+        raise ValueError("expected_qty out of range")
+    return {"sku": sku, "name": name, "expected_qty": expected_qty}
+
+
+def _upsert_products(rows, now):
+    # ON CONFLICT can't touch one row twice per statement: the last line for a SKU wins.
+    rows = [{**r, "updated_at": now} for r in {r["sku"]: r for r in rows}.values()]
+    stmt = _dialect_insert(Product)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["sku"],
+        set_={"name": stmt.excluded.name, "expected_qty": stmt.excluded.expected_qty, "updated_at": stmt.excluded.updated_at},
+    )
+    with connect() as conn, conn.begin():
+        conn.execute(stmt, rows)
+    return len(rows)
+
+
+def import_products(lines, replace=False):
+    """
+    Upserts catalog rows from CSV text lines with a header naming sku and optionally
+    name, expected_qty (other columns are ignored). Rows are committed in batches of
+    CATALOG_IMPORT_BATCH_ROWS, so a failed import can simply be re-run. With replace,
+    products not in the file are deleted once the whole file went through.
+    Returns (imported, rejected, deleted); ValueError if there is no sku column.
+    """
+    reader = csv.DictReader(lines)
+    if not reader.fieldnames or "sku" not in [f.strip() for f in reader.fieldnames]:
+        raise ValueError("header must name a sku column")
+    reader.fieldnames = [f.strip() for f in reader.fieldnames]
+    now = dt.datetime.utcnow()
+    imported, deleted, rejected, batch = 0, 0, [], []
+    try:
+        for rec in reader:
+            try:
+                batch.append(_catalog_row(rec))
+            except (ValueError, TypeError) as e:
+                if len(rejected) < CATALOG_MAX_REJECTED:
+                    rejected.append({"line": reader.line_num, "error": str(e)})
+                continue
+            if len(batch) >= CATALOG_IMPORT_BATCH_ROWS:
+                imported += _upsert_products(batch, now)
+                batch = []
+        if batch:
+            imported += _upsert_products(batch, now)
+        if replace:
+            with connect() as conn, conn.begin():
+                deleted = conn.execute(Product.__table__.delete().where(Product.updated_at < now)).rowcount
+    finally:
+        catalog_cache.clear()
+        scans_cache.clear()  # enriched bodies embed product fields
+    metrics.inc("catalog_rows_imported_total", imported)
+    return imported, rejected, deleted
+
+
+# ───────────────────────── Live stream ─────────────────────────
+# Off by default: every open stream holds a server thread for up to STREAM_MAX_SECONDS, which
+# needs threaded workers (gunicorn.conf.py). Pages only open it when /api/config says so.
+STREAM_ENABLED = os.getenv("STREAM_ENABLED", "0") == "1"
+# How a worker learns about rows other workers stored: "notify" (PostgreSQL LISTEN/NOTIFY),
+# "poll" (a query every STREAM_POLL_MS; the stand-in on SQLite) or "local" (own ingests only).
+STREAM_FANOUT = os.getenv("STREAM_FANOUT") or ("notify" if engine.dialect.name == "postgresql" else "poll")
+if STREAM_FANOUT == "notify" and engine.dialect.name != "postgresql":
+    STREAM_FANOUT = "poll"
+STREAM_CHANNEL = "scans"
+STREAM_POLL_MS = int(os.getenv("STREAM_POLL_MS", "1000"))
+STREAM_BUFFER_EVENTS = int(os.getenv("STREAM_BUFFER_EVENTS", "256"))
+STREAM_REPLAY_ROWS = int(os.getenv("STREAM_REPLAY_ROWS", "5000"))
+STREAM_MAX_SUBSCRIBERS = int(os.getenv("STREAM_MAX_SUBSCRIBERS", "16"))  # per worker; below its threads
+STREAM_MAX_SECONDS = int(os.getenv("STREAM_MAX_SECONDS", "600"))
+STREAM_HEARTBEAT_S = 15
+STREAM_FETCH_ROWS = 1000
+
+
+def notify_scans(conn):
+    """Inside the ingest transaction: tells every worker's listener once it commits."""
+    if STREAM_FANOUT == "notify":
+        conn.execute(text("SELECT pg_notify(:channel, '')"), {"channel": STREAM_CHANNEL})
+
+
+def _sse(event, seq, payload):
+    return f"id: {seq}\nevent: {event}\ndata: ".encode() + dumps(payload) + b"\n\n"
+
+
+class _StreamEvent:
+    """One published batch of rows, serialized once for every subscriber."""
+    __slots__ = ("first", "last", "rows", "body")
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.first, self.last = rows[0]["seq"], rows[-1]["seq"]
+        self.body = _sse("scans", self.last, {"scans": rows, "seq": self.last})
+
+
+class _Subscriber:
+    __slots__ = ("start", "events", "overflowed")
+
+    def __init__(self, start):
+        self.start = start  # the broker's mark when it subscribed: later events are new to it
+        self.events = []
+        self.overflowed = False
+
+
+class ScanBroker:
+    """
+    Publishes newly stored scans to this worker's /api/stream subscribers. A pump thread
+    (one per worker, started with the first subscriber) reads the rows past the last
+    published seq whenever it is woken: by a local ingest, a NOTIFY, or the poll timer.
+    Reading from the table rather than forwarding ingests keeps events in seq order with
+    no gaps across workers. A subscriber holds at most max_events unsent events; one that
+    overflows is emptied and catches up from the database.
+    """
+
+    def __init__(self, max_events):
+        self.max_events = max_events
+        self.last_seq = None
+        self._cond = threading.Condition()
+        self._subs = set()
+        self._wake = threading.Event()
+        self._pid = None
+
+    def full(self):
+        with self._cond:
+            return len(self._subs) >= STREAM_MAX_SUBSCRIBERS
+
+    def subscribe(self):
+        """A new subscriber, or None at STREAM_MAX_SUBSCRIBERS."""
+        with self._cond:
+            if len(self._subs) >= STREAM_MAX_SUBSCRIBERS:
+                return None
+            self._ensure_pump()
+            sub = _Subscriber(self.last_seq)
+            self._subs.add(sub)
+        metrics.add("stream_subscribers", 1)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._cond:
+            self._subs.discard(sub)
+        metrics.add("stream_subscribers", -1)
+
+    def wake(self):
+        if self._pid == os.getpid():
+            self._wake.set()
+
+    def wait(self, sub, timeout):
+        """Takes sub's pending events, waiting up to timeout for some; [] on timeout or overflow."""
+        with self._cond:
+            if not sub.events and not sub.overflowed:
+                self._cond.wait(timeout)
+            events, sub.events = sub.events, []
+            return events
+
+    def publish(self, event):
+        with self._cond:
+            self.last_seq = event.last
+            for sub in self._subs:
+                if len(sub.events) >= self.max_events:
+                    sub.events = []
+                    sub.overflowed = True
+                    metrics.inc("stream_overflows_total")
+                else:
+                    sub.events.append(event)
+            self._cond.notify_all()
+        metrics.inc("stream_events_total")
+
+    def _ensure_pump(self):
+        # Lazily, so each forked gunicorn worker gets its own threads. The starting mark is
+        # read before the first subscriber is added, so its replay always reaches it.
+        if self._pid == os.getpid():
+            return
+        with connect() as conn:
+            self.last_seq = conn.execute(_MAX_SEQ).scalar() or 0
+        self._pid = os.getpid()
+        threading.Thread(target=self._pump, name="scan-stream-pump", daemon=True).start()
+        if STREAM_FANOUT == "notify":
+            threading.Thread(target=self._listen, name="scan-stream-listen", daemon=True).start()
+
+    def _pump(self):
+        interval = STREAM_POLL_MS / 1000 if STREAM_FANOUT == "poll" else 30
+        while True:
+            self._wake.wait(interval)
+            self._wake.clear()
+            try:
+                self._publish_new()
+            except Exception:
+                app.logger.exception("scan stream pump failed")
+                time.sleep(1)
+
+    def _publish_new(self):
+        with connect() as conn:
+            with self._cond:
+                idle = not self._subs
+            if idle:  # nobody to send to: just keep the mark current
+                hwm = conn.execute(_MAX_SEQ).scalar() or 0
+                with self._cond:
+                    if not self._subs:
+                        self.last_seq = max(self.last_seq, hwm)
+                        return
+            while True:
+                rows = conn.execute(
+                    _SCAN_COLUMNS.where(Scan.id > self.last_seq).order_by(Scan.id).limit(STREAM_FETCH_ROWS)
+                ).all()
+                if not rows:
+                    return
+                self.publish(_StreamEvent(_scan_dicts(rows)))
+                if len(rows) < STREAM_FETCH_ROWS:
+                    return
+
+    def _listen(self):
+        """LISTEN on a dedicated connection outside the pool; every NOTIFY wakes the pump."""
+        import select as io_select
+        cargs, cparams = engine.dialect.create_connect_args(engine.url)
+        cparams.update(engine_options(DATABASE_URL)["connect_args"])
+        while True:
+            dbapi_conn = None
+            try:
+                dbapi_conn = engine.dialect.connect(*cargs, **cparams)
+                dbapi_conn.autocommit = True
+                with dbapi_conn.cursor() as cur:
+                    cur.execute(f"LISTEN {STREAM_CHANNEL}")
+                self._wake.set()  # catch up on anything committed while not listening
+                while True:
+                    if io_select.select([dbapi_conn], [], [], 30)[0]:
+                        dbapi_conn.poll()
+                        if dbapi_conn.notifies:
+                            dbapi_conn.notifies.clear()
+                            self._wake.set()
+            except Exception:
+                app.logger.exception("scan stream listener failed; reconnecting")
+                time.sleep(1)
+            finally:
+                if dbapi_conn is not None:
+                    with contextlib.suppress(Exception):
+                        dbapi_conn.close()
+
+
+stream_broker = ScanBroker(STREAM_BUFFER_EVENTS)
+
+
+def _replay(since):
+    """SSE bytes for the rows after since, read from the table, and the new last seq."""
+    with connect() as conn:
+        rows = conn.execute(
+            _SCAN_COLUMNS.where(Scan.id > since).order_by(Scan.id).limit(STREAM_REPLAY_ROWS + 1)
+        ).all()
+        if len(rows) > STREAM_REPLAY_ROWS:  # too far behind: have the client reload instead
+            hwm = conn.execute(_MAX_SEQ).scalar() or 0
+            return _sse("reset", hwm, {"seq": hwm}), hwm
+    if not rows:
+        return b"", since
+    return _sse("scans", rows[-1][0], {"scans": _scan_dicts(rows), "seq": rows[-1][0]}), rows[-1][0]
+
+
+def _stream_events(since):
+    # Subscribes on the first read of the body, so a response that is never sent (HEAD, a
+    # dropped client) leaves nothing behind; closing the generator unsubscribes.
+    sub = stream_broker.subscribe()
+    if sub is None:  # filled up since api_stream checked: the browser retries shortly
+        yield b"retry: 5000\n\n"
+        return
+    try:
+        yield b"retry: 3000\n\n"
+        last = sub.start if since is None else since
+        catch_up = since is not None
+        deadline = time.monotonic() + STREAM_MAX_SECONDS
+        while time.monotonic() < deadline:
+            if catch_up or sub.overflowed:
+                sub.overflowed = catch_up = False
+                chunk, last = _replay(last)
+                if chunk:
+                    yield chunk
+            events = stream_broker.wait(sub, STREAM_HEARTBEAT_S)
+            if not events:
+                if not sub.overflowed:
+                    yield b": ping\n\n"
+                continue
+            for ev in events:
+                if ev.last <= last:  # already sent by a replay
+                    continue
+                if ev.first > last:
+                    yield ev.body
+                else:
+                    rows = [r for r in ev.rows if r["seq"] > last]
+                    yield _sse("scans", ev.last, {"scans": rows, "seq": ev.last})
+                last = ev.last
+    finally:
+        stream_broker.unsubscribe(sub)
+
+
+# ───────────────────────── API ─────────────────────────
+@app.post("/api/scan")
+@instrumented("api_scan")
+def api_scan():
+    """
+    Accepts {"device_id":"...", "scans":[{"id":<localId>,"sku":"...", "count":1, "timestamp":"ISO"}]}
+    or the same rows as {"device_id":"...", "columnar":{...}} (see expand_columnar), either
+    optionally sent with Content-Encoding: gzip.
+    Returns {"synced_ids":[<localId>...], "duplicates":n, "rejected":[{"index":i,"id":<localId>,"error":"..."}],
+             "unknown_skus":["..."]}
+
+    Rows with SKUs missing from the products catalog are still stored; the SKUs are
+    listed under "unknown_skus" (always empty while the catalog has no products).
+
+    Idempotent per (device_id, id): ids the server has already stored are reported as
+    synced again and counted under "duplicates" instead of being inserted twice.
+
+    With INGEST_MODE=queue the batch goes through the write-behind queue: 429 when it is
+    full; with INGEST_ACK=enqueue the reply ({"queued": true}, no "duplicates") is sent
+    before the commit, otherwise after it.
+    """
+    try:
+        with metrics.phase("api_scan", "parse"):
+            data = read_upload()
+            scans = expand_columnar(data["columnar"]) if isinstance(data.get("columnar"), dict) else data.get("scans", [])
+    except PayloadTooLarge:
+        return jsonify({"error": "payload too large"}), 413
+    except (ValueError, TypeError, IndexError):
+        return jsonify({"error": "bad payload"}), 400
+    if not isinstance(scans, list):
+        return jsonify({"error": "bad payload"}), 400
+    if MAX_BATCH_ROWS and len(scans) > MAX_BATCH_ROWS:
+        return jsonify({"error": "batch too large", "max_batch_rows": MAX_BATCH_ROWS}), 413
+
+    with metrics.phase("api_scan", "validate"):
+        rows, synced_ids, rejected = normalize_batch(scans, data.get("device_id"))
+    metrics.observe("scan_batch_rows", len(scans))
+    metrics.inc("scan_rows_rejected_total", len(rejected))
+    try:
+        with metrics.phase("api_scan", "catalog"):
+            unknown = unknown_skus(rows)
+    except Exception as e:
+        return jsonify({"error": "server_error", "detail": str(e)}), 500
+    if unknown:
+        flagged = set(unknown)
+        metrics.inc("scan_rows_unknown_sku_total", sum(1 for r in rows if r["sku"] in flagged))
+    if ingest_queue is not None and rows:
+        return _enqueue_scan(rows, synced_ids, rejected, unknown)
+    try:
+        with metrics.phase("api_scan", "store"):
+            inserted, = store_batches([rows])
+        return jsonify({"synced_ids": synced_ids, "duplicates": len(rows) - len(inserted), "rejected": rejected,
+                        "unknown_skus": unknown})
+    except Exception as e:
+        return jsonify({"error": "server_error", "detail": str(e)}), 500
+
+
+def _enqueue_scan(rows, synced_ids, rejected, unknown):
+    try:
+        with metrics.phase("api_scan", "enqueue"):
+            batch = ingest_queue.submit(rows)
+    except QueueFull:
+        resp = jsonify({"error": "busy"})
+        resp.headers["Retry-After"] = "1"
+        return resp, 429
+    if INGEST_ACK == "enqueue":
+        return jsonify({"synced_ids": synced_ids, "rejected": rejected, "unknown_skus": unknown, "queued": True})
+    with metrics.phase("api_scan", "commit_wait"):
+        committed = batch.done.wait(INGEST_COMMIT_TIMEOUT)
+    if not committed:
+        # Still queued and will likely commit; the client's retry is deduplicated.
+        return jsonify({"error": "commit_timeout"}), 503
+    if batch.error is not None:
+        return jsonify({"error": "server_error", "detail": str(batch.error)}), 500
+    return jsonify({"synced_ids": synced_ids, "duplicates": len(rows) - len(batch.inserted), "rejected": rejected,
+                    "unknown_skus": unknown})
+
+
+def _iso(ts):
+    return ts.replace(tzinfo=dt.timezone.utc).isoformat()
+
+
+def _arg_ts(name):
+    """Optional ISO-8601 query arg -> naive UTC datetime; ValueError if malformed."""
+    raw = request.args.get(name)
+    if not raw:
+        return None
+    ts = dt.datetime.fromisoformat(raw.replace("Z", "+00:00"))
+    return ts.astimezone(dt.timezone.utc).replace(tzinfo=None) if ts.tzinfo else ts
+
+
+def _arg_limit(default=500, maximum=5000):
+    return min(max(int(request.args.get("limit", default)), 1), maximum)
+
+
+def encode_cursor(ts, row_id):
+    return base64.urlsafe_b64encode(f"{ts.isoformat()}|{row_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    ts, row_id = raw.rsplit("|", 1)
+    ts = dt.datetime.fromisoformat(ts)
+    if ts.tzinfo is not None:  # built by the page from a row's "+00:00" timestamp
+        ts = ts.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    return ts, int(row_id)
+
+
+_SCAN_COLUMNS = select(Scan.id, Scan.sku, Scan.count, Scan.timestamp)
+# Same rows with their catalog fields, in the same query (LEFT JOIN on the products PK).
+_ENRICHED_SCAN_COLUMNS = (
+    select(Scan.id, Scan.sku, Scan.count, Scan.timestamp, Product.name, Product.expected_qty)
+    .outerjoin(Product, Product.sku == Scan.sku)
+)
+_MAX_SEQ = select(func.max(Scan.id))
+# Archiving deletes old rows without moving max(id); the newest archive id covers that.
+_DATA_VERSION = select(func.max(Scan.id), select(func.max(ScanArchive.id)).scalar_subquery())
+
+
+def _scan_dicts(rows):
+    if rows and len(rows[0]) > 4:
+        return [
+            {"seq": r[0], "sku": r[1], "count": r[2], "timestamp": r[3], "name": r[4], "expected_qty": r[5]}
+            for r in rows
+        ]
+    return [{"seq": r[0], "sku": r[1], "count": r[2], "timestamp": r[3]} for r in rows]
+
+
+def _scans_since(conn, base, since, limit):
+    """Delta read: rows with seq > since in seq order, plus the new high-water mark."""
+    rows = conn.execute(base.where(Scan.id > since).order_by(Scan.id).limit(limit)).all()
+    body = dumps({"scans": _scan_dicts(rows), "seq": rows[-1][0] if rows else since, "more": len(rows) == limit})
+    return body, {}
+
+
+def _scans_page(conn, base, hwm, limit, start, end, before):
+    stmt = base
+    if request.args.get("sku"):
+        stmt = stmt.where(Scan.sku == request.args["sku"])
+    if start:
+        stmt = stmt.where(Scan.timestamp >= start)
+    if end:
+        stmt = stmt.where(Scan.timestamp < end)
+    if before:
+        stmt = stmt.where(tuple_(Scan.timestamp, Scan.id) < tuple_(*before))
+    rows = conn.execute(stmt.order_by(Scan.timestamp.desc(), Scan.id.desc()).limit(limit)).all()
+    headers = {"X-High-Water-Mark": str(hwm)}
+    if len(rows) == limit:
+        cursor = encode_cursor(rows[-1][3], rows[-1][0])
+        headers["X-Next-Cursor"] = cursor
+        next_args = {**request.args.to_dict(), "before": cursor}
+        headers["Link"] = f'<{url_for("api_scans", **next_args)}>; rel="next"'
+    return dumps(_scan_dicts(rows)), headers
+
+
+# Client sync tuning, advertised through /api/config so it can change without a client release.
+SYNC_CHUNK_SIZE = int(os.getenv("SYNC_CHUNK_SIZE", "500"))
+SYNC_CONCURRENCY = int(os.getenv("SYNC_CONCURRENCY", "2"))
+SYNC_BACKOFF_BASE_MS = int(os.getenv("SYNC_BACKOFF_BASE_MS", "1000"))
+SYNC_BACKOFF_MAX_MS = int(os.getenv("SYNC_BACKOFF_MAX_MS", "30000"))
+SYNC_MAX_ATTEMPTS = int(os.getenv("SYNC_MAX_ATTEMPTS", "5"))
+CONFIG_MAX_AGE = int(os.getenv("CONFIG_MAX_AGE", "300"))
+COMPACT_AFTER_HOURS = float(os.getenv("COMPACT_AFTER_HOURS", "72"))
+KEEP_SYNCED_RECORDS = int(os.getenv("KEEP_SYNCED_RECORDS", "2000"))
+
+# Scanner reader profiles, in BarcodeDetector format names. Every extra format is another
+# reader run on each frame and another source of misreads, so narrow it where the labels allow.
+DECODER_PROFILES = {
+    "retail": ["ean_13", "ean_8", "upc_a", "upc_e"],
+    "warehouse": ["ean_13", "ean_8", "upc_a", "upc_e", "code_128", "itf"],
+    "all": ["ean_13", "ean_8", "upc_a", "upc_e", "code_128", "code_39", "code_93", "codabar", "itf"],
+}
+DECODER_PROFILE = os.getenv("DECODER_PROFILE", "all")
+DECODER_INTERVAL_MS = int(os.getenv("DECODER_INTERVAL_MS", "100"))
+DECODER_ROI_WIDTH = int(os.getenv("DECODER_ROI_WIDTH", "640"))
+DECODER_DEBOUNCE_MS = int(os.getenv("DECODER_DEBOUNCE_MS", "1500"))
+
+
+def client_config():
+    return {
+        "sync": {
+            "chunk_size": min(SYNC_CHUNK_SIZE, MAX_BATCH_ROWS) if MAX_BATCH_ROWS else SYNC_CHUNK_SIZE,
+            "concurrency": SYNC_CONCURRENCY,
+            "backoff_base_ms": SYNC_BACKOFF_BASE_MS,
+            "backoff_max_ms": SYNC_BACKOFF_MAX_MS,
+            "max_attempts": SYNC_MAX_ATTEMPTS,
+            "max_batch_rows": MAX_BATCH_ROWS or None,
+            # On-device retention: synced records older than this, or beyond this many, are
+            # folded into the per-SKU aggregates and deleted.
+            "compact_after_hours": COMPACT_AFTER_HOURS,
+            "keep_synced_records": KEEP_SYNCED_RECORDS,
+        },
+        "decoder": {
+            "profile": DECODER_PROFILE if DECODER_PROFILE in DECODER_PROFILES else "all",
+            "formats": DECODER_PROFILES.get(DECODER_PROFILE, DECODER_PROFILES["all"]),
+            # Frame cadence, width the guide-box crop is downscaled to, and how long the
+            # same code must be out of view before it counts again.
+            "interval_ms": DECODER_INTERVAL_MS,
+            "roi_max_width": DECODER_ROI_WIDTH,
+            "debounce_ms": DECODER_DEBOUNCE_MS,
+        },
+        "stream": {"enabled": STREAM_ENABLED},
+    }
+
+
+@app.get("/api/stream")
+def api_stream():
+    """
+    Server-Sent Events feed of newly stored scans. Each "scans" event carries
+    {"scans":[...], "seq":<last seq>} with rows shaped like /api/scans?since= deltas, and
+    that seq as its event id.
+
+    Resumes after Last-Event-ID (or ?since=<seq> on the first connect): missed rows are
+    replayed from the table first. A client more than STREAM_REPLAY_ROWS rows behind gets
+    a "reset" event with the current seq instead and should reload. Streams end after
+    STREAM_MAX_SECONDS and the browser reconnects with its Last-Event-ID.
+
+    404 unless STREAM_ENABLED: every open stream holds a worker thread, so it needs the
+    threaded workers from gunicorn.conf.py. 503 past STREAM_MAX_SUBSCRIBERS per worker.
+    """
+    if not STREAM_ENABLED:
+        return jsonify({"error": "live stream disabled"}), 404
+    raw = request.headers.get("Last-Event-ID") or request.args.get("since")
+    try:
+        since = int(raw) if raw else None
+    except ValueError:
+        return jsonify({"error": "bad query"}), 400
+    if stream_broker.full():
+        resp = jsonify({"error": "busy"})
+        resp.headers["Retry-After"] = "5"
+        return resp, 503
+    return Response(
+        _stream_events(since), mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/config")
+def api_config():
+    resp = jsonify(client_config())
+    resp.headers["Cache-Control"] = f"public, max-age={CONFIG_MAX_AGE}"
+    return resp
+
+
+@app.get("/api/scans")
+@instrumented("api_scans")
+def api_scans():
+    """
+    Newest-first scan history.
+    Query: ?sku=&from=<ISO>&to=<ISO>&limit=<n, default 500>&before=<cursor>
+    When more rows remain, the X-Next-Cursor header (and a Link rel="next") carries the
+    cursor for the next page. Pages are keyset-seeks on (timestamp, id), never OFFSETs.
+    X-High-Water-Mark is the latest seq at read time, to start delta polling from.
+
+    With ?since=<seq> it instead returns {"scans":[...], "seq":<new mark>, "more":bool}:
+    only rows stored after that mark, oldest first.
+
+    With ?enrich=1 every row also carries the catalog "name" and "expected_qty" (null
+    for unknown SKUs), joined in the same query.
+
+    Reads plain column tuples (no ORM objects) and serves repeat queries from
+    scans_cache until the high-water mark (or the latest archive) moves. The ETag is that
+    mark, so an unchanged poll gets a 304 after a single index lookup; enriched reads add
+    the catalog version. Archived rows are not listed; see /api/export?include_archive=1.
+    """
+    try:
+        limit = _arg_limit()
+        since = int(request.args["since"]) if request.args.get("since") else None
+        start, end = _arg_ts("from"), _arg_ts("to")
+        before = decode_cursor(request.args["before"]) if request.args.get("before") else None
+    except (ValueError, UnicodeDecodeError):
+        return jsonify({"error": "bad query"}), 400
+    enrich = request.args.get("enrich") in ("1", "true")
+
+    with connect() as conn:
+        with metrics.phase("api_scans", "high_water_mark"):
+            hwm, archive = conn.execute(_DATA_VERSION).one()
+            hwm = hwm or 0
+            version = (hwm, archive)
+            etag = f"s{hwm}a{archive}" if archive else f"s{hwm}"
+            if enrich:
+                catalog_ts = conn.execute(_CATALOG_VERSION).scalar()
+                catalog_version = (catalog_ts - dt.datetime(1970, 1, 1)) // dt.timedelta(microseconds=1) if catalog_ts else 0
+                version = (hwm, archive, catalog_version)
+                etag = f"{etag}c{catalog_version}"
+        if request.if_none_match.contains_weak(etag):
+            metrics.inc("scans_cache_requests_total", result="not_modified")
+            resp = Response(status=304, headers={"Cache-Control": "no-cache"})
+            resp.set_etag(etag, weak=True)
+            return resp
+        key = request.query_string
+        cached = scans_cache.get(key, version)
+        metrics.inc("scans_cache_requests_total", result="miss" if cached is None else "hit")
+        if cached is None:
+            base = _ENRICHED_SCAN_COLUMNS if enrich else _SCAN_COLUMNS
+            with metrics.phase("api_scans", "query"):
+                if since is not None:
+                    cached = _scans_since(conn, base, since, limit)
+                else:
+                    cached = _scans_page(conn, base, hwm, limit, start, end, before)
+            scans_cache.put(key, version, cached)
+    body, headers = cached
+    resp = Response(body, mimetype="application/json", headers={**headers, "Cache-Control": "no-cache"})
+    resp.set_etag(etag, weak=True)
+    return resp
+
+
+EXPORT_BATCH_ROWS = 5000
+EXPORT_COLUMNS = ("seq", "sku", "count", "timestamp", "device_id", "client_id")
+
+
+def _export_csv(batches):
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(EXPORT_COLUMNS)
+    for batch in batches:
+        w.writerows((r.id, r.sku, r.count, _iso(r.timestamp), r.device_id, r.client_id) for r in batch)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():  # header only: empty range
+        yield buf.getvalue()
+
+
+def _export_ndjson(batches):
+    for batch in batches:
+        yield "".join(
+            json.dumps({
+                "seq": r.id, "sku": r.sku, "count": r.count, "timestamp": _iso(r.timestamp),
+                "device_id": r.device_id, "client_id": r.client_id,
+            }, separators=(",", ":")) + "\n"
+            for r in batch
+        )
+
+
+def _gzip_stream(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for chunk in chunks:
+        out = z.compress(chunk)
+        if out:
+            yield out
+    yield z.flush()
+
+
+def _stream_scans(stmt):
+    """Yields lists of rows from a server-side cursor, EXPORT_BATCH_ROWS at a time."""
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=EXPORT_BATCH_ROWS).execute(stmt)
+        yield from result.partitions()
+
+
+@app.get("/api/export")
+def api_export():
+    """
+    Streams the full scan history in (timestamp, id) order.
+    Query: ?format=csv|ndjson&from=<ISO>&to=<ISO>&gzip=1&include_archive=1
+    Rows come from a server-side cursor in fixed-size batches, so worker memory does not
+    grow with the table. gzip=1 sends a .gz attachment compressed on the fly.
+    include_archive=1 first streams the archived months overlapping the range from their
+    files (in archive order), then the live table.
+    """
+    fmt = request.args.get("format", "csv")
+    if fmt not in ("csv", "ndjson"):
+        return jsonify({"error": "bad format"}), 400
+    try:
+        start, end = _arg_ts("from"), _arg_ts("to")
+    except ValueError:
+        return jsonify({"error": "bad query"}), 400
+    archives = []
+    if request.args.get("include_archive") in ("1", "true"):
+        archives = archives_between(start, end)
+        missing = [a.path for a in archives if not os.path.exists(os.path.join(ARCHIVE_DIR, a.path))]
+        if missing:
+            return jsonify({"error": "archive_unavailable", "missing": missing}), 503
+
+    stmt = select(Scan.id, Scan.sku, Scan.count, Scan.timestamp, Scan.device_id, Scan.client_id)
+    if start:
+        stmt = stmt.where(Scan.timestamp >= start)
+    if end:
+        stmt = stmt.where(Scan.timestamp < end)
+    stmt = stmt.order_by(Scan.timestamp, Scan.id)
+
+    encode = _export_csv if fmt == "csv" else _export_ndjson
+    batches = _stream_scans(stmt)
+    if archives:
+        batches = itertools.chain(read_archives(archives, start, end), batches)
+    body = (chunk.encode() for chunk in encode(batches))
+    filename = f"scans.{fmt}"
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    if request.args.get("gzip") in ("1", "true"):
+        body, filename, mimetype = _gzip_stream(body), filename + ".gz", "application/gzip"
+    return Response(body, mimetype=mimetype, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+def _total_json(t, product=None):
+    out = {"sku": t.sku, "total_count": t.total_count, "first_seen": _iso(t.first_seen), "last_seen": _iso(t.last_seen)}
+    if product is not None:
+        name, expected_qty = product
+        out.update(name=name, expected_qty=expected_qty)
+    return out
+
+
+def _totals_query(session, enrich):
+    if not enrich:
+        return session.query(SkuTotal)
+    return session.query(SkuTotal, Product.name, Product.expected_qty).outerjoin(Product, Product.sku == SkuTotal.sku)
+
+
+@app.get("/api/totals")
+def api_totals():
+    """
+    Per-SKU totals from sku_totals, ordered by SKU.
+    Paginate with ?after=<last sku of previous page>&limit=<n> (default 500, max 5000).
+    ?enrich=1 adds the catalog name and expected_qty; ?unknown=1 keeps only SKUs that
+    are not in the catalog.
+    """
+    try:
+        limit = _arg_limit()
+    except ValueError:
+        return jsonify({"error": "bad limit"}), 400
+    enrich = request.args.get("enrich") in ("1", "true")
+    session = SessionLocal()
+    try:
+        q = _totals_query(session, enrich)
+        after = request.args.get("after")
+        if after:
+            q = q.filter(SkuTotal.sku > after)
+        if request.args.get("unknown") in ("1", "true"):
+            q = q.filter(~select(Product.sku).where(Product.sku == SkuTotal.sku).exists())
+        q = q.order_by(SkuTotal.sku).limit(limit)
+        if enrich:
+            return jsonify([_total_json(t, (name, qty)) for t, name, qty in q])
+        return jsonify([_total_json(t) for t in q])
+    finally:
+        session.close()
+
+
+@app.get("/api/totals/<path:sku>")
+def api_total(sku):
+    enrich = request.args.get("enrich") in ("1", "true")
+    session = SessionLocal()
+    try:
+        row = _totals_query(session, enrich).filter(SkuTotal.sku == sku).first()
+        if row is None:
+            return jsonify({"error": "not_found"}), 404
+        return jsonify(_total_json(row[0], row[1:]) if enrich else _total_json(row))
+    finally:
+        session.close()
+
+
+@app.post("/api/products/import")
+def api_products_import():
+    """
+    Bulk catalog load: a CSV body (optionally Content-Encoding: gzip) with a header row
+    naming sku and optionally name, expected_qty. The body is parsed as it streams in and
+    upserted in batches. ?replace=1 also deletes products missing from the file.
+    Returns {"imported":n, "deleted":n, "rejected":[{"line":n, "error":"..."}]} (first 100).
+    """
+    stream = request.stream
+    encoding = request.headers.get("Content-Encoding", "").lower()
+    if encoding == "gzip":
+        stream = gzip.GzipFile(fileobj=stream)
+    elif encoding not in ("", "identity"):
+        return jsonify({"error": "unsupported encoding"}), 415
+    lines = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    try:
+        imported, rejected, deleted = import_products(lines, replace=request.args.get("replace") in ("1", "true"))
+    except (ValueError, UnicodeDecodeError, OSError, EOFError, csv.Error) as e:
+        return jsonify({"error": "bad csv", "detail": str(e)}), 400
+    return jsonify({"imported": imported, "deleted": deleted, "rejected": rejected})
+
+
+@app.get("/api/products/<path:sku>")
+def api_product(sku):
+    product = lookup_products([sku])[sku]
+    if product is None:
+        return jsonify({"error": "not_found"}), 404
+    return jsonify(product)
+
+
+STATS_DEFAULT_SPAN = {"hour": dt.timedelta(hours=48), "day": dt.timedelta(days=90)}
+
+
+@app.get("/api/stats")
+def api_stats():
+    """
+    Scan velocity from the hourly/daily rollup tables.
+    Query: ?granularity=hour|day&sku=&from=<ISO>&to=<ISO> (default: the last 48 hours / 90 days)
+    Returns {"granularity", "sku", "buckets":[{"bucket":ISO, "count":n}]}; without sku
+    the counts are summed across all SKUs.
+    """
+    granularity = request.args.get("granularity", "hour")
+    if granularity not in ROLLUPS:
+        return jsonify({"error": "bad granularity"}), 400
+    try:
+        start, end = _arg_ts("from"), _arg_ts("to")
+    except ValueError:
+        return jsonify({"error": "bad query"}), 400
+    end = end or dt.datetime.utcnow()
+    start = bucket_start(granularity, start or end - STATS_DEFAULT_SPAN[granularity])
+
+    model = ROLLUPS[granularity]
+    sku = request.args.get("sku")
+    if sku:
+        stmt = select(model.bucket, model.total_count).where(model.sku == sku)
+    else:
+        stmt = select(model.bucket, func.sum(model.total_count)).group_by(model.bucket)
+    stmt = stmt.where(model.bucket >= start, model.bucket < end).order_by(model.bucket)
+    with engine.connect() as conn:
+        rows = conn.execute(stmt).all()
+    return jsonify({
+        "granularity": granularity,
+        "sku": sku,
+        "buckets": [{"bucket": _iso(b), "count": int(n)} for b, n in rows],
+    })
+
+
+@app.get("/api/archives")
+def api_archives():
+    """Archived months: [{"month", "path", "format", "rows", "last_seq", "archived_at"}], oldest first."""
+    with engine.connect() as conn:
+        rows = conn.execute(select(ScanArchive).order_by(ScanArchive.month, ScanArchive.id)).all()
+    return jsonify([
+        {"month": _iso(a.month), "path": a.path, "format": a.format, "rows": a.rows,
+         "last_seq": a.last_seq, "archived_at": _iso(a.archived_at)}
+        for a in rows
+    ])
+
+
+# ───────────────────────── Partitions & archive ─────────────────────────
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "365"))
+ARCHIVE_FORMATS = {"ndjson": ".ndjson.gz", "parquet": ".parquet"}
+ArchivedScan = namedtuple("ArchivedScan", "id sku count timestamp device_id client_id")
+
+
+def month_start(ts):
+    return ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(month):
+    return month.replace(year=month.year + 1, month=1) if month.month == 12 else month.replace(month=month.month + 1)
+
+
+def _partition_name(month):
+    return f"scans_p{month:%Y%m}"
+
+
+def create_partitioned_scans(conn):
+    """The scans table, range-partitioned by month, with a DEFAULT partition for strays."""
+    conn.execute(text(
+        "CREATE TABLE scans ("
+        " id serial NOT NULL, sku varchar(128) NOT NULL, count integer NOT NULL,"
+        " timestamp timestamp without time zone NOT NULL, device_id varchar(64), client_id varchar(64),"
+        " PRIMARY KEY (id, timestamp),"
+        " CONSTRAINT uq_scans_device_client UNIQUE (device_id, client_id, timestamp)"
+        ") PARTITION BY RANGE (timestamp)"
+    ))
+    conn.execute(text("CREATE INDEX ix_scans_sku ON scans (sku)"))
+    conn.execute(text("CREATE INDEX ix_scans_timestamp_id ON scans (timestamp, id)"))
+    conn.execute(text("CREATE INDEX ix_scans_sku_timestamp_id ON scans (sku, timestamp, id)"))
+    conn.execute(text("CREATE TABLE scans_default PARTITION OF scans DEFAULT"))
+
+
+def scan_partitions(conn):
+    """Names of the monthly partitions of scans (not the default one)."""
+    return set(conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'scans'::regclass AND c.relname <> 'scans_default'"
+    )).scalars())
+
+
+def create_partition(conn, month):
+    """
+    Adds the month's partition. Rows of that month already sitting in the default
+    partition are moved into it, as PostgreSQL refuses the partition otherwise.
+    """
+    lo, hi = month, next_month(month)
+    bounds = {"lo": lo, "hi": hi}
+    strays = conn.execute(text(
+        "SELECT 1 FROM scans_default WHERE timestamp >= :lo AND timestamp < :hi LIMIT 1"
+    ), bounds).first()
+    if strays:
+        conn.execute(text(
+            "CREATE TEMP TABLE scans_moving ON COMMIT DROP AS "
+            "SELECT * FROM scans_default WHERE timestamp >= :lo AND timestamp < :hi"
+        ), bounds)
+        conn.execute(text("DELETE FROM scans_default WHERE timestamp >= :lo AND timestamp < :hi"), bounds)
+    conn.execute(text(
+        f"CREATE TABLE {_partition_name(month)} PARTITION OF scans "
+        f"FOR VALUES FROM ('{lo:%Y-%m-%d}') TO ('{hi:%Y-%m-%d}')"
+    ))
+    if strays:
+        conn.execute(text("INSERT INTO scans SELECT * FROM scans_moving"))
+        conn.execute(text("DROP TABLE scans_moving"))
+
+
+def ensure_partitions(conn, ahead, first=None):
+    """Creates the missing partitions from first (default: this month) to `ahead` months on."""
+    existing = scan_partitions(conn)
+    month = month_start(first or dt.datetime.utcnow())
+    last = month_start(dt.datetime.utcnow())
+    for _ in range(ahead):
+        last = next_month(last)
+    created = []
+    while month <= last:
+        if _partition_name(month) not in existing:
+            create_partition(conn, month)
+            created.append(_partition_name(month))
+        month = next_month(month)
+    return created
+
+
+def scans_is_partitioned(conn):
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'scans'::regclass"
+    )).first() is not None
+
+
+def convert_to_partitioned(conn):
+    """
+    Rebuilds an existing plain scans table as a partitioned one, in one transaction and
+    under an exclusive lock: ingestion stops until it commits, and a failure leaves the
+    old table untouched. Ids are kept.
+    """
+    conn.execute(text("LOCK TABLE scans IN ACCESS EXCLUSIVE MODE"))
+    if scans_is_partitioned(conn):
+        raise ValueError("scans is already partitioned")
+    columns = {c["name"] for c in inspect(conn).get_columns("scans")}
+    # The old table is dropped at the end: free its index and constraint names for the new one.
+    conn.execute(text("ALTER TABLE scans DROP CONSTRAINT IF EXISTS uq_scans_device_client"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_scans_sku, ix_scans_timestamp_id, ix_scans_sku_timestamp_id"))
+    conn.execute(text("ALTER TABLE scans RENAME TO scans_unpartitioned"))
+    conn.execute(text("ALTER TABLE scans_unpartitioned RENAME CONSTRAINT scans_pkey TO scans_unpartitioned_pkey"))
+    create_partitioned_scans(conn)
+    oldest = conn.execute(text("SELECT min(timestamp) FROM scans_unpartitioned")).scalar()
+    ensure_partitions(conn, PARTITION_MONTHS_AHEAD, first=oldest)
+    cols = ("id", "sku", "count", "timestamp", "device_id", "client_id")
+    source = ", ".join(c if c in columns else f"NULL AS {c}" for c in cols)  # tables older than the origin columns
+    n = conn.execute(text(f"INSERT INTO scans ({', '.join(cols)}) SELECT {source} FROM scans_unpartitioned")).rowcount
+    conn.execute(text(
+        "SELECT setval(pg_get_serial_sequence('scans', 'id'), (SELECT coalesce(max(id), 0) + 1 FROM scans), false)"
+    ))
+    conn.execute(text("DROP TABLE scans_unpartitioned"))
+    return n
+
+
+def _archive_row(r):
+    return ArchivedScan(r.id, r.sku, r.count, r.timestamp, r.device_id, r.client_id)
+
+
+def _write_archive(batches, path, fmt):
+    """Writes row batches to path via a temp file that is fsynced and renamed into place."""
+    tmp = path + ".tmp"
+    if fmt == "parquet":
+        import pyarrow as pa  # optional, and slow to import: only for parquet archives
+        import pyarrow.parquet as pq
+        schema = pa.schema([
+            ("seq", pa.int64()), ("sku", pa.string()), ("count", pa.int32()), ("timestamp", pa.timestamp("us")),
+            ("device_id", pa.string()), ("client_id", pa.string()),
+        ])
+        with pq.ParquetWriter(tmp, schema, compression="zstd") as w:
+            for batch in batches:
+                w.write_table(pa.Table.from_pydict(
+                    {name: list(col) for name, col in zip(EXPORT_COLUMNS, zip(*batch))}, schema=schema
+                ))
+        with open(tmp, "rb+") as f:
+            os.fsync(f.fileno())
+    else:
+        # Same line format as /api/export?format=ndjson.
+        with open(tmp, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6, mtime=0) as f:
+                for chunk in _export_ndjson(batches):
+                    f.write(chunk.encode())
+            raw.flush()
+            os.fsync(raw.fileno())
+    os.replace(tmp, path)
+
+
+def archive_month(month, fmt):
+    """
+    Moves every scan of the month into a file under ARCHIVE_DIR and records it in
+    scan_archives. Rows are written out first and deleted only once the file is on disk,
+    in the same transaction as the scan_archives row. On a partitioned table the month's
+    partition is dropped outright unless rows arrived in it meanwhile. On SQLite the
+    newest scan is never archived. Returns the number of rows archived.
+    """
+    lo, hi = month, next_month(month)
+    in_month = (Scan.timestamp >= lo, Scan.timestamp < hi)
+    with engine.connect() as conn:
+        # Ids become visible in order (see insert_scans), so every row up to this mark is
+        # committed and anything stored later is above it and stays.
+        hwm = conn.execute(_MAX_SEQ).scalar() or 0
+        if conn.dialect.name == "sqlite" and conn.execute(select(Scan.id).where(*in_month, Scan.id == hwm)).first():
+            # SQLite numbers new rows max(id) + 1: emptying the table would restart ids below
+            # what clients and the live feed have seen, so the newest row always stays.
+            hwm -= 1
+        n = conn.execute(select(func.count()).where(*in_month, Scan.id <= hwm)).scalar()
+    if not n:
+        return 0
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    name = f"scans-{month:%Y-%m}-{hwm}{ARCHIVE_FORMATS[fmt]}"
+    stmt = (
+        select(Scan.id, Scan.sku, Scan.count, Scan.timestamp, Scan.device_id, Scan.client_id)
+        .where(*in_month, Scan.id <= hwm).order_by(Scan.timestamp, Scan.id)
+    )
+    _write_archive(_stream_scans(stmt), os.path.join(ARCHIVE_DIR, name), fmt)
+
+    with engine.begin() as conn:
+        partition = _partition_name(month)
+        dropped = False
+        if SCANS_PARTITIONED and conn.dialect.name == "postgresql":
+            conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": SEQ_LOCK_KEY})  # holds off ingest
+            if partition in scan_partitions(conn):
+                late = conn.execute(text(f"SELECT 1 FROM {partition} WHERE id > :hwm LIMIT 1"), {"hwm": hwm}).first()
+                if not late:
+                    conn.execute(text(f"ALTER TABLE scans DETACH PARTITION {partition}"))
+                    conn.execute(text(f"DROP TABLE {partition}"))
+                    dropped = True
+        if not dropped:
+            conn.execute(Scan.__table__.delete().where(*in_month, Scan.id <= hwm))
+        conn.execute(ScanArchive.__table__.insert().values(
+            month=month, path=name, format=fmt, rows=n, last_seq=hwm, archived_at=dt.datetime.utcnow()
+        ))
+    scans_cache.clear()
+    return n
+
+
+def archive_older_than(days, fmt):
+    """Archives every month that ended more than `days` ago; yields (month, rows)."""
+    cutoff = month_start(dt.datetime.utcnow() - dt.timedelta(days=days))
+    with engine.connect() as conn:
+        oldest = conn.execute(select(func.min(Scan.timestamp))).scalar()
+    month = month_start(oldest) if oldest else cutoff
+    while next_month(month) <= cutoff:
+        n = archive_month(month, fmt)
+        if n:
+            yield month, n
+        month = next_month(month)
+
+
+def archives_between(start, end):
+    """scan_archives rows whose month overlaps [start, end), oldest first."""
+    stmt = select(ScanArchive)
+    if start:
+        stmt = stmt.where(ScanArchive.month >= month_start(start))
+    if end:
+        stmt = stmt.where(ScanArchive.month < end)
+    with engine.connect() as conn:
+        return conn.execute(stmt.order_by(ScanArchive.month, ScanArchive.id)).all()
+
+
+def _read_archive(path, fmt):
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=EXPORT_BATCH_ROWS):
+            cols = batch.to_pydict()
+            yield [ArchivedScan(*row) for row in zip(*(cols[c] for c in EXPORT_COLUMNS))]
+        return
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        while True:
+            lines = list(itertools.islice(f, EXPORT_BATCH_ROWS))
+            if not lines:
+                return
+            batch = []
+            for line in lines:
+                d = json.loads(line)
+                ts = dt.datetime.fromisoformat(d["timestamp"]).replace(tzinfo=None)  # written as UTC
+                batch.append(ArchivedScan(d["seq"], d["sku"], d["count"], ts, d["device_id"], d["client_id"]))
+            yield batch
+
+
+def read_archives(archives, start, end):
+    """Row batches from archive files, restricted to [start, end); same shape as _stream_scans."""
+    for a in archives:
+        for batch in _read_archive(os.path.join(ARCHIVE_DIR, a.path), a.format):
+            batch = [r for r in batch if (not start or r.timestamp >= start) and (not end or r.timestamp < end)]
+            if batch:
+                yield batch
+
+
+# ───────────────────────── CLI ─────────────────────────
+@app.cli.command("init-db")
+def init_db_command():
+    """Create or migrate the schema. Run before starting gunicorn; workers do not do it at import."""
+    try:
+        changes = init_db()
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print(f"schema ready on {engine.url.render_as_string(hide_password=True)}; changed: {', '.join(changes) or 'nothing'}")
+
+
+@app.cli.command("rebuild-totals")
+def rebuild_totals_command():
+    """Recompute sku_totals from the scans table and the archive files."""
+    try:
+        with engine.begin() as conn:
+            n = rebuild_totals(conn)
+    except OSError as e:
+        raise click.ClickException(f"archive unreadable, nothing rebuilt: {e}")
+    print(f"sku_totals rebuilt: {n} SKUs")
+
+
+@app.cli.command("backfill-rollups")
+def backfill_rollups_command():
+    """Recompute the hourly and daily rollup tables from the scans table and the archive files."""
+    for granularity in ROLLUPS:
+        try:
+            with engine.begin() as conn:
+                n = rebuild_rollup(conn, granularity)
+        except OSError as e:
+            raise click.ClickException(f"archive unreadable, {ROLLUPS[granularity].__tablename__} not rebuilt: {e}")
+        print(f"{ROLLUPS[granularity].__tablename__} rebuilt: {n} buckets")
+
+
+@app.cli.command("partitions")
+@click.option("--ahead", default=PARTITION_MONTHS_AHEAD, show_default=True, help="Months to create past this one.")
+@click.option("--convert", is_flag=True, help="Rebuild an existing plain scans table as a partitioned one first.")
+def partitions_command(ahead, convert):
+    """Pre-create monthly scans partitions (PostgreSQL, SCANS_PARTITIONED=1). Run from cron."""
+    if engine.dialect.name != "postgresql" or not SCANS_PARTITIONED:
+        raise click.ClickException("partitioning needs PostgreSQL and SCANS_PARTITIONED=1")
+    with engine.begin() as conn:
+        if convert:
+            try:
+                print(f"scans converted: {convert_to_partitioned(conn)} rows copied")
+            except ValueError as e:
+                raise click.ClickException(str(e))
+        created = ensure_partitions(conn, ahead)
+        existing = sorted(scan_partitions(conn))
+    print(f"created: {', '.join(created) or 'none'}; partitions: {', '.join(existing)}")
+
+
+@app.cli.command("archive-scans")
+@click.option("--days", default=ARCHIVE_RETENTION_DAYS, show_default=True, help="Keep months newer than this many days.")
+@click.option("--format", "fmt", type=click.Choice(sorted(ARCHIVE_FORMATS)), default="ndjson", show_default=True)
+def archive_scans_command(days, fmt):
+    """Move whole months of scans older than the retention window into files under ARCHIVE_DIR."""
+    total = 0
+    for month, n in archive_older_than(days, fmt):
+        print(f"{month:%Y-%m}: {n} rows archived")
+        total += n
+    print(f"archived {total} rows to {os.path.abspath(ARCHIVE_DIR)}")
 
 
 # ───────────────────────── Run (local dev) ─────────────────────────
 if __name__ == "__main__":
+    init_db()
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", "8000")))
@@ -0,0 +1,81 @@
+"""
+Rows/sec for POST /api/scan on SQLite: legacy per-row ORM adds (scans table only) vs. the
+current path through store_batches(), which also maintains sku_totals and the rollups.
+
+    python bench/bench_ingest.py [--sizes 1,100,10000] [--repeat 5]
+"""
+import argparse
+import datetime as dt
+import os
+import sys
+import tempfile
+import time
+
+_tmp = tempfile.mkdtemp(prefix="scan-bench-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp, 'bench.db')}"  # never an operator's real database
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as scanner  # noqa: E402
+
+scanner.init_db()
+
+
+def make_payload(n):
+    now = dt.datetime.utcnow()
+    return [
+        {"id": i, "sku": f"SKU{i % 250:05d}", "count": 1, "timestamp": (now + dt.timedelta(seconds=i)).isoformat() + "Z"}
+        for i in range(n)
+    ]
+
+
+def legacy_ingest(scans):
+    """The pre-bulk handler body: one ORM object and one session.add() per row."""
+    session = scanner.SessionLocal()
+    try:
+        for s in scans:
+            sku = str(s.get("sku", "")).strip()
+            count = int(s.get("count", 1) or 1)
+            ts_raw = s.get("timestamp")
+            try:
+                ts = dt.datetime.fromisoformat(ts_raw.replace("Z", "+00:00")) if isinstance(ts_raw, str) else dt.datetime.utcnow()
+            except Exception:
+                ts = dt.datetime.utcnow()
+            if not sku:
+                continue
+            session.add(scanner.Scan(sku=sku, count=count, timestamp=ts))
+        session.commit()
+    finally:
+        session.close()
+
+
+def bulk_ingest(scans):
+    """What POST /api/scan does in sync mode: the insert plus sku_totals and rollup upkeep."""
+    rows, _, _ = scanner.normalize_batch(scans)
+    scanner.store_batches([rows])
+
+
+def measure(fn, payload, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(payload)
+        best = min(best, time.perf_counter() - t0)
+    return len(payload) / best
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="1,100,10000")
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    print(f"{'batch':>8} {'legacy rows/s':>15} {'bulk rows/s':>15} {'speedup':>8}")
+    for n in (int(x) for x in args.sizes.split(",")):
+        payload = make_payload(n)
+        legacy = measure(legacy_ingest, payload, args.repeat)
+        bulk = measure(bulk_ingest, payload, args.repeat)
+        print(f"{n:>8} {legacy:>15,.0f} {bulk:>15,.0f} {bulk / legacy:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
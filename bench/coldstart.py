@@ -0,0 +1,57 @@
+"""
+Worker cold-start time: a fresh interpreter importing app and serving its first request,
+with and without running the schema setup that used to happen at import.
+
+    python bench/coldstart.py [--runs 10] [--database-url URL]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+if {init}:
+    app.init_db()
+t2 = time.perf_counter()
+app.app.test_client().get("/api/scans?limit=1")
+t3 = time.perf_counter()
+print(t1 - t0, t2 - t1, t3 - t2)
+"""
+
+
+def sample(init, runs, env):
+    out = []
+    for _ in range(runs):
+        r = subprocess.run([sys.executable, "-c", PROBE.format(init=init)], cwd=ROOT, env=env,
+                           capture_output=True, text=True, check=True)
+        out.append([float(x) * 1000 for x in r.stdout.split()])
+    return [statistics.median(col) for col in zip(*out)]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=10)
+    ap.add_argument("--database-url")
+    args = ap.parse_args()
+
+    url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='scan-cold-'), 'cold.db')}"
+    env = {**os.environ, "DATABASE_URL": url}
+    subprocess.run([sys.executable, "-c", "import app; app.init_db()"], cwd=ROOT, env=env, check=True)
+
+    print(f"median of {args.runs} fresh interpreters, {url.split(':', 1)[0]}")
+    print(f"{'':<24} {'import':>9} {'schema':>9} {'1st req':>9} {'total':>9}")
+    for label, init in (("schema at import (old)", True), ("explicit init-db (new)", False)):
+        imp, schema, first = sample(init, args.runs, env)
+        print(f"{label:<24} {imp:>7.1f}ms {schema:>7.1f}ms {first:>7.1f}ms {imp + schema + first:>7.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+Headless decode benchmark for the scanner's worker fallback.
+
+Runs the page's decoder worker (app.DECODER_WORKER_JS, unmodified) under Node against the
+fixture frames in bench/fixtures/decode, once on the full frame and once on the guide-box
+crop downscaled the way the page does it, and reports decode time per frame:
+
+    npm install --prefix bench @zxing/library@0.20.0
+    python bench/decode.py run [--profile retail] [--roi-width 640] [--repeat 20]
+    python bench/decode.py fixtures        # regenerate the fixture frames
+
+The native BarcodeDetector path needs a real browser and is not covered here.
+Fixtures are 1280x720 greyscale frames (gzipped PGM) named <format>-<text>-<variant>, or
+none-<variant> for frames without a barcode; sensor noise is added at load time.
+"""
+import argparse
+import gzip
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "bench", "fixtures", "decode")
+W, H = 1280, 720
+
+HARNESS = r"""
+const fs = require('fs'), zlib = require('zlib'), path = require('path'), vm = require('vm');
+const [workerFile, zxing, dir, roiWidth, formats, repeat] = process.argv.slice(1);  // node -e: no script path
+globalThis.self = globalThis;
+globalThis.importScripts = () => { globalThis.ZXing = require(zxing); };
+let reply = null;
+globalThis.postMessage = m => { reply = m; };
+vm.runInThisContext(fs.readFileSync(workerFile, 'utf8'), { filename: 'decoder-worker.js' });
+self.onmessage({ data: { type: 'init', formats: JSON.parse(formats) } });
+
+function readPgm(file) {
+  const buf = zlib.gunzipSync(fs.readFileSync(file));
+  const [magic, w, h, max] = buf.toString('latin1', 0, 32).split(/\s+/, 4);
+  const offset = buf.length - w * h;
+  return { width: +w, height: +h, pixels: buf.subarray(offset) };
+}
+// Guide box (CSS margin: 10%, which is 10% of the width on every side) downscaled to
+// maxWidth by area averaging, as drawImage does; 0 keeps the full frame.
+function frame(img, maxWidth) {
+  let sx = 0, sy = 0, sw = img.width, sh = img.height;
+  if (maxWidth > 0) { const m = Math.round(img.width * 0.1); sx = m; sy = m; sw = img.width - 2 * m; sh = img.height - 2 * m; }
+  const scale = maxWidth > 0 ? Math.min(1, maxWidth / sw) : 1;
+  const w = Math.round(sw * scale), h = Math.round(sh * scale);
+  const rgba = new Uint8ClampedArray(w * h * 4);
+  let seed = 12345;
+  for (let y = 0; y < h; y++) {
+    const y0 = sy + Math.floor(y / scale), y1 = Math.max(y0 + 1, sy + Math.floor((y + 1) / scale));
+    for (let x = 0; x < w; x++) {
+      const x0 = sx + Math.floor(x / scale), x1 = Math.max(x0 + 1, sx + Math.floor((x + 1) / scale));
+      let sum = 0;
+      for (let yy = y0; yy < y1; yy++) for (let xx = x0; xx < x1; xx++) sum += img.pixels[yy * img.width + xx];
+      seed = (seed * 1103515245 + 12345) & 0x7fffffff;
+      const v = sum / ((y1 - y0) * (x1 - x0)) + (seed % 25) - 12;
+      const o = (y * w + x) * 4;
+      rgba[o] = rgba[o + 1] = rgba[o + 2] = v; rgba[o + 3] = 255;
+    }
+  }
+  return { width: w, height: h, rgba };
+}
+
+for (const name of fs.readdirSync(dir).filter(f => f.endsWith('.pgm.gz')).sort()) {
+  const f = frame(readPgm(path.join(dir, name)), +roiWidth);
+  const times = [];
+  let code = null;
+  for (let i = 0; i < +repeat; i++) {
+    const data = f.rgba.slice().buffer;
+    const t0 = performance.now();
+    self.onmessage({ data: { type: 'decode', width: f.width, height: f.height, data } });
+    times.push(performance.now() - t0);
+    code = reply.code;
+  }
+  console.log(JSON.stringify({ name, width: f.width, height: f.height, code, times }));
+}
+"""
+
+
+# ───────────────────────── Fixtures ─────────────────────────
+L_CODES = ["0001101", "0011001", "0010011", "0111101", "0100011", "0110001", "0101111", "0111011", "0110111", "0001011"]
+R_CODES = ["".join("1" if b == "0" else "0" for b in c) for c in L_CODES]
+G_CODES = [c[::-1] for c in R_CODES]
+EAN13_PARITY = ["LLLLLL", "LLGLGG", "LLGGLG", "LLGGGL", "LGLLGG", "LGGLLG", "LGGGLL", "LGLGLG", "LGLGGL", "LGGLGL"]
+
+
+def check_digit(digits):
+    total = sum(int(d) * (3 if i % 2 == 0 else 1) for i, d in enumerate(reversed(digits)))
+    return str((10 - total % 10) % 10)
+
+
+def ean13_modules(text):
+    first, left, right = int(text[0]), text[1:7], text[7:]
+    parity = EAN13_PARITY[first]
+    out = "101"
+    out += "".join((L_CODES if p == "L" else G_CODES)[int(d)] for p, d in zip(parity, left))
+    out += "01010" + "".join(R_CODES[int(d)] for d in right) + "101"
+    return out
+
+
+def ean8_modules(text):
+    return "101" + "".join(L_CODES[int(d)] for d in text[:4]) + "01010" + "".join(R_CODES[int(d)] for d in text[4:]) + "101"
+
+
+def render(modules, module_px, blur, offset=(0, 0)):
+    """A label with the symbol on a shaded background, centred in the guide box plus offset."""
+    bars = bytearray()
+    for m in "0" * 10 + modules + "0" * 10:          # quiet zones
+        bars += bytes([28 if m == "1" else 232]) * module_px
+    for _ in range(blur):                              # defocus: repeated 3-tap box blur
+        bars = bytearray([bars[0]]) + bytearray(
+            (bars[i - 1] + bars[i] + bars[i + 1]) // 3 for i in range(1, len(bars) - 1)
+        ) + bytearray([bars[-1]])
+    bar_h = max(60, len(bars) // 3)
+    x0 = (W - len(bars)) // 2 + offset[0]
+    y0 = (H - bar_h) // 2 + offset[1]
+    img = bytearray()
+    for y in range(H):
+        row = bytearray([90 + 50 * y // H]) * W
+        if y0 <= y < y0 + bar_h:
+            row[x0:x0 + len(bars)] = bars
+        img += row
+    return img
+
+
+def render_empty(stripes):
+    """Background only, optionally with shelf-edge stripes that are not a barcode."""
+    img = bytearray()
+    for y in range(H):
+        shade = 90 + 50 * y // H
+        if stripes and (y // 40) % 3 == 0:
+            shade = 200 if (y // 40) % 2 else 40
+        img += bytearray([shade]) * W
+    return img
+
+
+def write_pgm(name, img):
+    with gzip.GzipFile(os.path.join(FIXTURES, name + ".pgm.gz"), "wb", mtime=0) as f:
+        f.write(b"P5\n%d %d\n255\n" % (W, H))
+        f.write(img)
+
+
+def make_fixtures(args):
+    os.makedirs(FIXTURES, exist_ok=True)
+    for old in os.listdir(FIXTURES):
+        if old.endswith(".pgm.gz"):
+            os.remove(os.path.join(FIXTURES, old))
+    ean13 = "590123412345"
+    ean13 += check_digit(ean13)
+    upca = "03600029145"
+    upca += check_digit(upca)
+    ean8 = "9638507"
+    ean8 += check_digit(ean8)
+    cases = [
+        ("ean_13", ean13, ean13_modules(ean13), [("near", 5, 0), ("far", 2, 0), ("blur", 4, 2), ("offset", 3, 1)]),
+        ("upc_a", upca, ean13_modules("0" + upca), [("near", 5, 0), ("far", 2, 1)]),
+        ("ean_8", ean8, ean8_modules(ean8), [("near", 6, 0), ("far", 3, 1)]),
+    ]
+    for fmt, text, modules, variants in cases:
+        for variant, px, blur in variants:
+            offset = (90, -60) if variant == "offset" else (0, 0)
+            write_pgm(f"{fmt}-{text}-{variant}", render(modules, px, blur, offset))
+    write_pgm("none-plain", render_empty(False))
+    write_pgm("none-stripes", render_empty(True))
+    print(f"wrote {len(os.listdir(FIXTURES))} fixtures to {FIXTURES}")
+
+
+# ───────────────────────── Run ─────────────────────────
+def expected(name):
+    parts = name[:-len(".pgm.gz")].split("-")
+    return None if parts[0] == "none" else parts[1]
+
+
+def same_code(got, want):
+    # UPC-A comes back as 12 digits or as the equivalent EAN-13 with a leading zero
+    return got == want or (got is not None and want is not None and got.lstrip("0") == want.lstrip("0"))
+
+
+def run_mode(args, worker_file, zxing, formats, roi_width):
+    out = subprocess.run(
+        [args.node, "-e", HARNESS, worker_file, zxing, FIXTURES, str(roi_width), json.dumps(formats), str(args.repeat)],
+        capture_output=True, text=True,
+    )
+    if out.returncode:
+        sys.exit(out.stderr.strip())
+    return [json.loads(line) for line in out.stdout.splitlines() if line.startswith("{")]
+
+
+def run(args):
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault("DATABASE_URL", "sqlite://")
+    import app
+
+    if not shutil.which(args.node):
+        sys.exit(f"{args.node} not found")
+    zxing = args.zxing or os.path.join(ROOT, "bench", "node_modules", "@zxing", "library")
+    if not os.path.isdir(zxing):
+        sys.exit("ZXing not found: npm install --prefix bench @zxing/library@0.20.0 (or pass --zxing)")
+    formats = app.DECODER_PROFILES[args.profile]
+
+    with tempfile.NamedTemporaryFile("w", suffix=".js", delete=False) as f:
+        f.write(app.DECODER_WORKER_JS)
+    try:
+        modes = [("full frame", 0), (f"guide box @{args.roi_width}px", args.roi_width)]
+        print(f"profile={args.profile} ({', '.join(formats)}), {args.repeat} decodes per fixture, median/p95 ms")
+        print(f"{'fixture':<34}" + "".join(f"{label:>28}" for label, _ in modes))
+        results = {label: run_mode(args, f.name, zxing, formats, width) for label, width in modes}
+    finally:
+        os.unlink(f.name)
+
+    for i, first in enumerate(results[modes[0][0]]):
+        cells = []
+        for label, _ in modes:
+            r = results[label][i]
+            t = sorted(r["times"])
+            ok = "ok" if same_code(r["code"], expected(r["name"])) else "MISS"
+            p95 = t[min(len(t) - 1, int(len(t) * 0.95))]
+            cells.append(f"{statistics.median(t):>8.2f} {p95:>8.2f} {ok:>4} {r['width']:>4}w")
+        print(f"{first['name'][:-7]:<34}" + "".join(f"{c:>28}" for c in cells))
+    for label, _ in modes:
+        rows = results[label]
+        all_times = [t for r in rows for t in r["times"]]
+        hits = sum(same_code(r["code"], expected(r["name"])) for r in rows)
+        print(f"{label:<20} {hits}/{len(rows)} correct, median {statistics.median(all_times):.2f}ms/frame, "
+              f"mean {statistics.fmean(all_times):.2f}ms/frame")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    r = sub.add_parser("run")
+    r.add_argument("--profile", default="all", help="reader profile from app.DECODER_PROFILES")
+    r.add_argument("--roi-width", type=int, default=640)
+    r.add_argument("--repeat", type=int, default=20)
+    r.add_argument("--node", default="node")
+    r.add_argument("--zxing", help="path to @zxing/library")
+    r.set_defaults(func=run)
+
+    f = sub.add_parser("fixtures")
+    f.set_defaults(func=make_fixtures)
+
+    args = ap.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
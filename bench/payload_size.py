@@ -0,0 +1,99 @@
+"""
+Upload size and server decode throughput: row-format JSON vs. the columnar format,
+each plain and gzipped, for a simulated day-long offline backlog.
+
+    python bench/payload_size.py [--rows 5000] [--skus 300]
+"""
+import argparse
+import datetime as dt
+import gzip
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+_tmp = tempfile.mkdtemp(prefix="scan-payload-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp, 'bench.db')}"  # never an operator's real database
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as scanner  # noqa: E402
+
+scanner.init_db()
+
+
+def backlog(n, n_skus):
+    """What a device accumulates offline: ids in order, a few seconds between scans."""
+    skus = [f"{random.randrange(10**12):013d}" for _ in range(n_skus)]
+    t = dt.datetime(2024, 5, 1, 8, 0, 0)
+    rows = []
+    for i in range(n):
+        t += dt.timedelta(milliseconds=random.randrange(500, 8000))
+        rows.append({"id": i + 1, "sku": random.choice(skus), "count": 1,
+                     "ts": t.isoformat(timespec="milliseconds") + "Z"})
+    return rows
+
+
+def row_format(rows):
+    return {"device_id": "bench", "scans": [
+        {"id": r["id"], "sku": r["sku"], "count": r["count"], "timestamp": r["ts"]} for r in rows
+    ]}
+
+
+def columnar_format(rows):
+    """Mirror of the page's toColumnar()."""
+    skus, index, idx, deltas, prev = [], {}, [], [], None
+    for r in rows:
+        k = index.setdefault(r["sku"], len(skus))
+        if k == len(skus):
+            skus.append(r["sku"])
+        t = int(dt.datetime.fromisoformat(r["ts"].replace("Z", "+00:00")).timestamp() * 1000)
+        idx.append(k)
+        deltas.append(0 if prev is None else t - prev)
+        prev = t
+    t0 = int(dt.datetime.fromisoformat(rows[0]["ts"].replace("Z", "+00:00")).timestamp() * 1000)
+    return {"device_id": "bench", "columnar": {
+        "ids": [r["id"] for r in rows], "skus": skus, "sku_idx": idx,
+        "counts": [r["count"] for r in rows], "t0": t0, "dt": deltas,
+    }}
+
+
+def post_rate(body, headers, n, repeat=3):
+    client = scanner.app.test_client()
+    best = float("inf")
+    for i in range(repeat):
+        with scanner.engine.begin() as conn:
+            conn.execute(scanner.Scan.__table__.delete())
+        t0 = time.perf_counter()
+        r = client.post("/api/scan", data=body, headers=headers)
+        best = min(best, time.perf_counter() - t0)
+        assert r.status_code == 200, r.data
+    return n / best
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=5000)
+    ap.add_argument("--skus", type=int, default=300)
+    args = ap.parse_args()
+    random.seed(1)
+    rows = backlog(args.rows, args.skus)
+
+    plain = {"Content-Type": "application/json"}
+    gz = {**plain, "Content-Encoding": "gzip"}
+    variants = []
+    for label, payload in (("rows", row_format(rows)), ("columnar", columnar_format(rows))):
+        body = json.dumps(payload, separators=(",", ":")).encode()
+        variants.append((label, body, plain))
+        variants.append((label + "+gzip", gzip.compress(body, 6), gz))
+
+    base = len(variants[0][1])
+    print(f"{args.rows} rows, {args.skus} distinct SKUs")
+    print(f"{'format':<16} {'bytes':>10} {'vs rows':>8} {'server rows/s':>14}")
+    for label, body, headers in variants:
+        print(f"{label:<16} {len(body):>10,} {len(body) / base:>7.1%} {post_rate(body, headers, args.rows):>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
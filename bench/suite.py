@@ -0,0 +1,346 @@
+"""
+Reproducible benchmark suite for the scan API.
+
+Drives the app either in-process through the Flask test client or over HTTP against a
+real local gunicorn, on a throwaway SQLite file or a PostgreSQL URL you provide:
+
+    python bench/suite.py run --target testclient
+    python bench/suite.py run --target gunicorn --workers 4
+    python bench/suite.py run --target gunicorn --database-url postgresql://localhost/scans_bench
+    python bench/suite.py run --read-sizes 10000,1000000,10000000 --requests 500
+    python bench/suite.py compare bench/results/abc1234.json bench/results/def5678.json
+
+Measures /api/scan ingest rows/sec across batch sizes x concurrency, /api/scans p50/p99
+latency at each table size, and RSS per serving process. Results are written to
+bench/results/<commit>.json (or --out) for comparison across commits.
+
+The PostgreSQL database is truncated between phases: never point it at real data.
+"""
+import argparse
+import concurrent.futures as cf
+import datetime as dt
+import json
+import os
+import platform
+import random
+import resource
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SKUS = 1000
+SEED_START = dt.datetime(2020, 1, 1)  # seeded history is one row per second from here
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, capture_output=True, text=True)
+        return out.stdout.strip() + ("-dirty" if dirty.stdout.strip() else "")
+    except OSError:
+        return "unknown"
+
+
+def percentile(values, p):
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def rss_kb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def make_batch(n, device):
+    now = dt.datetime.utcnow()
+    return {
+        "device_id": device,
+        "scans": [
+            {"id": i, "sku": f"SKU{random.randrange(SKUS):05d}", "count": 1,
+             "timestamp": (now - dt.timedelta(seconds=i)).isoformat() + "Z"}
+            for i in range(n)
+        ],
+    }
+
+
+# ───────────────────────── Targets ─────────────────────────
+class TestClientTarget:
+    """The app imported into this process; requests go through werkzeug's test client."""
+
+    name = "testclient"
+
+    def __init__(self, app_module):
+        self.app = app_module
+
+    def post(self, path, payload):
+        r = self.app.app.test_client().post(path, json=payload)
+        return r.status_code
+
+    def get(self, path):
+        r = self.app.app.test_client().get(path)
+        return r.status_code
+
+    def worker_rss_kb(self):
+        return {str(os.getpid()): rss_kb(os.getpid())}
+
+    def close(self):
+        pass
+
+
+class GunicornTarget:
+    """A real gunicorn master + workers on a free localhost port."""
+
+    name = "gunicorn"
+
+    def __init__(self, workers, env):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        self.base = f"http://127.0.0.1:{self.port}"
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-w", str(workers), "-b", f"127.0.0.1:{self.port}", "app:app"],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                urllib.request.urlopen(self.base + "/health", timeout=1).read()
+                return
+            except OSError:
+                time.sleep(0.1)
+        self.close()
+        raise RuntimeError("gunicorn did not come up")
+
+    def post(self, path, payload):
+        req = urllib.request.Request(
+            self.base + path, data=json.dumps(payload).encode(), headers={"Content-Type": "application/json"}
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=120) as r:
+                r.read()
+                return r.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def get(self, path):
+        try:
+            with urllib.request.urlopen(self.base + path, timeout=120) as r:
+                r.read()
+                return r.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def worker_rss_kb(self):
+        out = subprocess.run(["pgrep", "-P", str(self.proc.pid)], capture_output=True, text=True).stdout.split()
+        return {pid: rss_kb(pid) for pid in out}
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.send_signal(signal.SIGTERM)
+            try:
+                self.proc.wait(30)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+
+# ───────────────────────── Phases ─────────────────────────
+def reset(app_module):
+    with app_module.engine.begin() as conn:
+        for table in reversed(app_module.Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+    app_module.scans_cache.clear()
+
+
+def seed(app_module, rows, chunk=50_000):
+    """Bulk-loads synthetic history straight through the ingestion helpers."""
+    done = 0
+    while done < rows:
+        n = min(chunk, rows - done)
+        batch = [
+            {"sku": f"SKU{random.randrange(SKUS):05d}", "count": 1,
+             "timestamp": SEED_START + dt.timedelta(seconds=done + i), "device_id": None, "client_id": None}
+            for i in range(n)
+        ]
+        app_module.store_batches([batch])
+        done += n
+
+
+def bench_ingest(target, app_module, batch_sizes, concurrencies, total_rows):
+    results = []
+    for size in batch_sizes:
+        for conc in concurrencies:
+            reset(app_module)
+            n_batches = max(conc, total_rows // size)
+            payloads = [make_batch(size, f"bench-{i}") for i in range(n_batches)]
+            statuses = []
+            t0 = time.perf_counter()
+            with cf.ThreadPoolExecutor(conc) as pool:
+                statuses = list(pool.map(lambda p: target.post("/api/scan", p), payloads))
+            elapsed = time.perf_counter() - t0
+            ok = sum(1 for s in statuses if s == 200)
+            results.append({
+                "batch_size": size, "concurrency": conc, "batches": n_batches, "ok": ok,
+                "errors": n_batches - ok, "seconds": round(elapsed, 4),
+                "rows_per_sec": round(ok * size / elapsed, 1),
+            })
+            print(f"  ingest batch={size:<6} conc={conc:<3} {results[-1]['rows_per_sec']:>12,.0f} rows/s"
+                  f"  ({n_batches - ok} errors)")
+    return results
+
+
+def bench_reads(target, app_module, sizes, n_requests):
+    results = []
+    for size in sizes:
+        reset(app_module)
+        t0 = time.perf_counter()
+        seed(app_module, size)
+        print(f"  seeded {size:,} rows in {time.perf_counter() - t0:.1f}s")
+
+        def instant():
+            return SEED_START + dt.timedelta(seconds=random.randrange(size))
+
+        def window():
+            t = instant()
+            return f"from={t.isoformat()}Z&to={(t + dt.timedelta(hours=1)).isoformat()}Z"
+
+        # Every request gets its own cursor or window: a repeated URL would be answered from
+        # scans_cache and time the cache instead of the query.
+        queries = {
+            "page": lambda: f"/api/scans?before={app_module.encode_cursor(instant(), 2**31 - 1)}",
+            "by_sku": lambda: f"/api/scans?sku=SKU{random.randrange(SKUS):05d}&before={app_module.encode_cursor(instant(), 2**31 - 1)}",
+            "range": lambda: f"/api/scans?{window()}&limit=100",
+        }
+        entry = {"rows": size}
+        for label, make_path in queries.items():
+            timings = []
+            for _ in range(n_requests):
+                path = make_path()
+                t = time.perf_counter()
+                status = target.get(path)
+                timings.append((time.perf_counter() - t) * 1000)
+                if status != 200:
+                    raise RuntimeError(f"GET {path} -> {status}")
+            entry[label] = {
+                "p50_ms": round(percentile(timings, 50), 3),
+                "p99_ms": round(percentile(timings, 99), 3),
+                "mean_ms": round(statistics.fmean(timings), 3),
+            }
+            print(f"  read rows={size:<10,} {label:<7} p50={entry[label]['p50_ms']:.2f}ms p99={entry[label]['p99_ms']:.2f}ms")
+        results.append(entry)
+    return results
+
+
+# ───────────────────────── CLI ─────────────────────────
+def ints(s):
+    return [int(x) for x in s.split(",") if x]
+
+
+def run(args):
+    tmp = tempfile.mkdtemp(prefix="scan-suite-")
+    database_url = args.database_url or f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+    os.environ["DATABASE_URL"] = database_url
+    sys.path.insert(0, ROOT)
+    import app as app_module
+
+    app_module.init_db()
+    if args.target == "gunicorn":
+        target = GunicornTarget(args.workers, {**os.environ, "DATABASE_URL": database_url})
+    else:
+        target = TestClientTarget(app_module)
+
+    random.seed(args.seed)
+    report = {
+        "commit": git_commit(),
+        "recorded_at": dt.datetime.utcnow().isoformat() + "Z",
+        "target": target.name,
+        "workers": args.workers if args.target == "gunicorn" else 1,
+        "database": database_url.split(":", 1)[0],
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "env": {k: v for k, v in os.environ.items() if k.startswith("INGEST_")},
+    }
+    try:
+        print(f"[{report['commit']}] target={target.name} db={report['database']}")
+        report["ingest"] = bench_ingest(target, app_module, ints(args.batch_sizes), ints(args.concurrency), args.ingest_rows)
+        report["reads"] = bench_reads(target, app_module, ints(args.read_sizes), args.requests)
+        report["worker_rss_kb"] = target.worker_rss_kb()
+        report["bench_max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        target.close()
+
+    out = args.out or os.path.join(ROOT, "bench", "results", f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {out}")
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.head) as f:
+        head = json.load(f)
+    print(f"{base['commit']} -> {head['commit']}")
+
+    def delta(a, b):
+        return f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+
+    base_ingest = {(r["batch_size"], r["concurrency"]): r for r in base.get("ingest", [])}
+    for r in head.get("ingest", []):
+        b = base_ingest.get((r["batch_size"], r["concurrency"]))
+        if b:
+            print(f"  ingest batch={r['batch_size']:<6} conc={r['concurrency']:<3} "
+                  f"{b['rows_per_sec']:>12,.0f} -> {r['rows_per_sec']:>12,.0f} rows/s ({delta(b['rows_per_sec'], r['rows_per_sec'])})")
+    base_reads = {r["rows"]: r for r in base.get("reads", [])}
+    for r in head.get("reads", []):
+        b = base_reads.get(r["rows"])
+        if not b:
+            continue
+        for label, m in r.items():
+            if label == "rows" or label not in b:
+                continue
+            print(f"  read rows={r['rows']:<10,} {label:<7} p99 {b[label]['p99_ms']:.2f} -> {m['p99_ms']:.2f}ms "
+                  f"({delta(b[label]['p99_ms'], m['p99_ms'])})")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    r = sub.add_parser("run")
+    r.add_argument("--target", choices=("testclient", "gunicorn"), default="testclient")
+    r.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    r.add_argument("--database-url", help="defaults to a fresh SQLite file")
+    r.add_argument("--batch-sizes", default="1,100,1000")
+    r.add_argument("--concurrency", default="1,4,16")
+    r.add_argument("--ingest-rows", type=int, default=20_000, help="rows posted per ingest cell")
+    r.add_argument("--read-sizes", default="10000,100000", help="table sizes for the read phase, up to 10M")
+    r.add_argument("--requests", type=int, default=200, help="requests per read query shape")
+    r.add_argument("--seed", type=int, default=1)
+    r.add_argument("--out")
+    r.set_defaults(func=run)
+
+    c = sub.add_parser("compare")
+    c.add_argument("base")
+    c.add_argument("head")
+    c.set_defaults(func=compare)
+
+    args = ap.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
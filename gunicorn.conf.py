@@ -0,0 +1,39 @@
+# Read by gunicorn from the working directory: `gunicorn app:app` picks it up.
+# Workers (WEB_CONCURRENCY) and the bind address ($PORT) keep gunicorn's own env handling.
+import glob
+import os
+import shutil
+import tempfile
+
+# Threaded workers: a slow request, or an open /api/stream feed (STREAM_ENABLED=1), holds one
+# thread instead of the whole worker. Keep STREAM_MAX_SUBSCRIBERS below `threads` so streams
+# always leave threads free for uploads and /health.
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "32"))
+
+
+# With METRICS_ENABLED=1 every worker publishes its counters to METRICS_DIR so /metrics can
+# sum them; without one each scrape would only see the worker that answered it. Runs in the
+# master before any worker is forked (and imports app), so they all inherit the directory.
+_default_metrics_dir = None
+
+
+def on_starting(server):
+    global _default_metrics_dir
+    if os.getenv("METRICS_ENABLED", "0") != "1":
+        return
+    directory = os.getenv("METRICS_DIR")
+    if not directory:
+        _default_metrics_dir = tempfile.mkdtemp(prefix="scan-metrics-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        os.environ["METRICS_DIR"] = _default_metrics_dir
+        server.log.info("METRICS_DIR not set, using %s", _default_metrics_dir)
+        return
+    # Snapshots of a previous run's workers would otherwise be summed in as exited workers.
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        os.remove(path)
+
+
+def on_exit(server):
+    if _default_metrics_dir:
+        shutil.rmtree(_default_metrics_dir, ignore_errors=True)
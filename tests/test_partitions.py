@@ -0,0 +1,303 @@
+"""
+Monthly partitions and archival of old scans.
+
+The archive tests run on a throwaway SQLite file by default. Point TEST_DATABASE_URL at an
+empty PostgreSQL database to run them on a partitioned scans table, plus the conversion
+and partition tests (tables in that database are dropped):
+
+    python -m pytest tests
+    TEST_DATABASE_URL=postgresql://localhost/scans_test python -m pytest tests
+"""
+import datetime as dt
+import gzip
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+DATABASE_URL = os.getenv("TEST_DATABASE_URL") or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}"
+POSTGRES = DATABASE_URL.startswith("postgresql")
+os.environ["DATABASE_URL"] = DATABASE_URL
+os.environ["SCANS_PARTITIONED"] = "1" if POSTGRES else "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+from sqlalchemy import func, inspect, select, text  # noqa: E402
+
+postgres_only = pytest.mark.skipif(not POSTGRES, reason="needs TEST_DATABASE_URL=postgresql://...")
+
+OLD_MONTHS = [dt.datetime(2024, 1, 1), dt.datetime(2024, 2, 1), dt.datetime(2024, 3, 1)]
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    app.Base.metadata.drop_all(app.engine)
+    app.init_db()
+    app.scans_cache.clear()
+    yield
+    app.scans_cache.clear()
+
+
+@pytest.fixture
+def client(db):
+    return app.app.test_client()
+
+
+def rows_in(month, n, device="dev"):
+    return [
+        {"sku": f"S{i % 3}", "count": i % 4 + 1, "timestamp": month + dt.timedelta(days=i % 27, minutes=i),
+         "device_id": device, "client_id": f"{month:%Y%m}-{i}"}
+        for i in range(n)
+    ]
+
+
+def seed_history():
+    """40 rows in each of three old months, 10 from this month."""
+    app.store_batches([rows_in(m, 40) for m in OLD_MONTHS] + [rows_in(app.month_start(dt.datetime.utcnow()), 10)])
+
+
+def live_rows():
+    with app.engine.connect() as conn:
+        return conn.execute(select(app.Scan.id, app.Scan.sku, app.Scan.count).order_by(app.Scan.id)).all()
+
+
+def totals(client):
+    return {r["sku"]: (r["total_count"], r["first_seen"], r["last_seen"]) for r in client.get("/api/totals").get_json()}
+
+
+def rollups():
+    with app.engine.connect() as conn:
+        return {
+            g: sorted(conn.execute(select(m.bucket, m.sku, m.total_count)).all()) for g, m in app.ROLLUPS.items()
+        }
+
+
+# ───────────────────────── Archive ─────────────────────────
+def test_archive_moves_old_months_to_files(client):
+    seed_history()
+    before = live_rows()
+
+    archived = list(app.archive_older_than(60, "ndjson"))
+
+    assert archived == [(m, 40) for m in OLD_MONTHS]
+    assert len(live_rows()) == 10
+    listed = client.get("/api/archives").get_json()
+    assert [a["rows"] for a in listed] == [40, 40, 40]
+    assert all(a["last_seq"] == before[-1].id for a in listed)
+    path = os.path.join(app.ARCHIVE_DIR, listed[0]["path"])
+    with gzip.open(path, "rt") as f:
+        first = json.loads(f.readline())
+    assert first["seq"] == before[0].id and first["client_id"] == "202401-0"
+    # Nothing left to archive: a second run is a no-op.
+    assert list(app.archive_older_than(60, "ndjson")) == []
+
+
+def test_ids_keep_growing_after_archiving_every_row(client):
+    app.store_batches([rows_in(m, 5) for m in OLD_MONTHS])
+    newest = live_rows()[-1].id
+
+    list(app.archive_older_than(60, "ndjson"))
+
+    inserted = app.store_batches([rows_in(app.month_start(dt.datetime.utcnow()), 1, device="new")])[0]
+    assert inserted[0]["id"] > newest
+    assert client.get(f"/api/scans?since={newest}").get_json()["seq"] == inserted[0]["id"]
+
+
+def test_export_include_archive_reads_archived_months_back(client):
+    seed_history()
+    everything = client.get("/api/export?format=ndjson").get_data(as_text=True).splitlines()
+    list(app.archive_older_than(60, "ndjson"))
+
+    live = client.get("/api/export?format=ndjson").get_data(as_text=True).splitlines()
+    merged = client.get("/api/export?format=ndjson&include_archive=1").get_data(as_text=True).splitlines()
+
+    assert len(live) == 10
+    assert merged == everything  # archived months are older, so file order is export order
+    ranged = client.get("/api/export?format=ndjson&include_archive=1&from=2024-02-01T00:00:00Z&to=2024-03-01T00:00:00Z")
+    months = {json.loads(line)["timestamp"][:7] for line in ranged.get_data(as_text=True).splitlines()}
+    assert months == {"2024-02"}
+
+
+def test_export_refuses_when_an_archive_file_is_missing(client):
+    seed_history()
+    list(app.archive_older_than(60, "ndjson"))
+    os.remove(os.path.join(app.ARCHIVE_DIR, client.get("/api/archives").get_json()[1]["path"]))
+
+    r = client.get("/api/export?format=ndjson&include_archive=1")
+
+    assert r.status_code == 503
+    assert r.get_json()["error"] == "archive_unavailable"
+
+
+def test_rebuilds_count_archived_rows(client):
+    seed_history()
+    want_totals, want_rollups = totals(client), rollups()
+    list(app.archive_older_than(60, "ndjson"))
+
+    with app.engine.begin() as conn:
+        app.rebuild_totals(conn)
+    for granularity in app.ROLLUPS:
+        with app.engine.begin() as conn:
+            app.rebuild_rollup(conn, granularity)
+
+    assert totals(client) == want_totals
+    assert rollups() == want_rollups
+
+
+def test_rebuild_refuses_without_the_archive_files(client):
+    seed_history()
+    want = totals(client)
+    list(app.archive_older_than(60, "ndjson"))
+    os.remove(os.path.join(app.ARCHIVE_DIR, client.get("/api/archives").get_json()[0]["path"]))
+
+    with pytest.raises(OSError):
+        with app.engine.begin() as conn:
+            app.rebuild_totals(conn)
+
+    assert totals(client) == want  # rolled back, not rebuilt from what was left
+
+
+# ───────────────────────── Partitions (PostgreSQL) ─────────────────────────
+def partitions():
+    with app.engine.connect() as conn:
+        return sorted(app.scan_partitions(conn))
+
+
+@postgres_only
+def test_init_db_creates_partitioned_scans(db):
+    this_month = app.month_start(dt.datetime.utcnow())
+    months = [this_month]
+    for _ in range(app.PARTITION_MONTHS_AHEAD):
+        months.append(app.next_month(months[-1]))
+    assert partitions() == [app._partition_name(m) for m in months]
+    with app.engine.connect() as conn:
+        assert app.scans_is_partitioned(conn)
+        assert app.init_db() == []  # already up to date
+
+
+@postgres_only
+def test_ingest_dedups_on_partitioned_scans(client):
+    body = {"device_id": "d", "scans": [{"id": i, "sku": "A", "timestamp": "2024-01-05T10:00:00Z"} for i in range(3)]}
+    assert client.post("/api/scan", json=body).get_json()["duplicates"] == 0
+    assert client.post("/api/scan", json=body).get_json()["duplicates"] == 3
+    with app.engine.connect() as conn:
+        # No partition for January 2024: the rows wait in the default one.
+        assert conn.execute(text("SELECT count(*) FROM scans_default")).scalar() == 3
+        app.create_partition(conn, OLD_MONTHS[0])
+        assert conn.execute(text("SELECT count(*) FROM scans_default")).scalar() == 0
+        assert conn.execute(text("SELECT count(*) FROM scans_p202401")).scalar() == 3
+        conn.commit()
+    assert client.post("/api/scan", json=body).get_json()["duplicates"] == 3
+
+
+@postgres_only
+def test_group_commit_copy_does_not_restage_earlier_batches(db):
+    month = app.month_start(dt.datetime.utcnow())
+    anonymous = [dict(r, device_id=None, client_id=None) for r in rows_in(month, app.COPY_MIN_ROWS)]
+
+    results = app.store_batches([anonymous, rows_in(month, app.COPY_MIN_ROWS + 10)])
+
+    assert [len(r) for r in results] == [app.COPY_MIN_ROWS, app.COPY_MIN_ROWS + 10]
+    assert len(live_rows()) == 2 * app.COPY_MIN_ROWS + 10
+
+
+@postgres_only
+def test_convert_to_partitioned_keeps_rows_and_ids(db):
+    # A plain scans table as an older deploy left it: no origin columns, no listing indexes.
+    with app.engine.begin() as conn:
+        conn.execute(text("DROP TABLE scans"))
+        conn.execute(text(
+            "CREATE TABLE scans (id serial PRIMARY KEY, sku varchar(128) NOT NULL, count integer NOT NULL,"
+            " timestamp timestamp without time zone NOT NULL)"
+        ))
+        conn.execute(text("CREATE INDEX ix_scans_sku ON scans (sku)"))
+        for month in OLD_MONTHS:
+            conn.execute(text("INSERT INTO scans (sku, count, timestamp) VALUES ('A', 2, :ts), ('B', 1, :ts)"),
+                         {"ts": month + dt.timedelta(days=3)})
+    before = live_rows()
+
+    with app.engine.begin() as conn:
+        assert app.convert_to_partitioned(conn) == len(before)
+
+    assert live_rows() == before
+    with app.engine.connect() as conn:
+        assert app.scans_is_partitioned(conn)
+        assert not inspect(conn).has_table("scans_unpartitioned")
+        indexes = {i["name"] for i in inspect(conn).get_indexes("scans")}
+    assert {"ix_scans_sku", "ix_scans_timestamp_id", "ix_scans_sku_timestamp_id"} <= indexes
+    assert {"scans_p202401", "scans_p202402", "scans_p202403"} <= set(partitions())
+    inserted = app.store_batches([rows_in(OLD_MONTHS[1], 1)])[0]
+    assert inserted[0]["id"] > before[-1].id
+
+    with pytest.raises(ValueError):
+        with app.engine.begin() as conn:
+            app.convert_to_partitioned(conn)
+
+
+@postgres_only
+def test_init_db_refuses_a_plain_scans_table(db):
+    with app.engine.begin() as conn:
+        conn.execute(text("DROP TABLE scans"))
+        app.Scan.__table__.create(conn)
+
+    with pytest.raises(ValueError, match="partitions --convert"):
+        app.init_db()
+
+
+@postgres_only
+def test_convert_rolls_back_on_failure(db, monkeypatch):
+    with app.engine.begin() as conn:
+        conn.execute(text("DROP TABLE scans"))  # a plain table, as create_all() makes it
+        app.Scan.__table__.create(conn)
+        conn.execute(app.Scan.__table__.insert(), rows_in(OLD_MONTHS[0], 20))
+    before = live_rows()
+
+    def broken(conn, ahead, first=None):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(app, "ensure_partitions", broken)
+    with pytest.raises(RuntimeError):
+        with app.engine.begin() as conn:
+            app.convert_to_partitioned(conn)
+
+    assert live_rows() == before
+    with app.engine.connect() as conn:
+        assert not app.scans_is_partitioned(conn)
+
+
+@postgres_only
+def test_archive_drops_whole_partitions(client):
+    with app.engine.begin() as conn:
+        for month in OLD_MONTHS:
+            app.create_partition(conn, month)
+    seed_history()
+
+    list(app.archive_older_than(60, "ndjson"))
+
+    assert not {"scans_p202401", "scans_p202402", "scans_p202403"} & set(partitions())
+    assert len(live_rows()) == 10
+    merged = client.get("/api/export?format=ndjson&include_archive=1").get_data(as_text=True).splitlines()
+    assert len(merged) == 3 * 40 + 10
+
+
+@postgres_only
+def test_archive_keeps_partition_with_rows_past_the_mark(client, monkeypatch):
+    with app.engine.begin() as conn:
+        app.create_partition(conn, OLD_MONTHS[0])
+    app.store_batches([rows_in(OLD_MONTHS[0], 5)])
+    real_write = app._write_archive
+
+    def write_then_ingest(batches, path, fmt):
+        real_write(batches, path, fmt)
+        app.store_batches([rows_in(OLD_MONTHS[0], 1, device="late")])  # lands while the file is written
+
+    monkeypatch.setattr(app, "_write_archive", write_then_ingest)
+    assert app.archive_month(OLD_MONTHS[0], "ndjson") == 5
+
+    assert "scans_p202401" in partitions()
+    with app.engine.connect() as conn:
+        left = conn.execute(select(app.Scan.device_id, func.count()).group_by(app.Scan.device_id)).all()
+    assert left == [("late", 1)]